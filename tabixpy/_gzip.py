@@ -1,7 +1,19 @@
+import os
 import gzip
+import zlib
+import hashlib
+import mmap
+import bisect
+import operator
+import queue
 import struct
+import threading
+
+from array        import array
+from collections  import OrderedDict
 
 from ._logger     import logger, getLogLevel
+from ._vcf        import VcfRecord
 from ._consts     import BLOCK_SIZE
 
 GZIP_MAGIC          = b"\x1F\x8B"
@@ -17,116 +29,527 @@ class EOF:
     pass
 
 
+class BlockCache():
+    # LRU cache of decompressed BGZF blocks keyed by (file fingerprint, real offset).
+    # can be shared between Tabix instances and threads.
+    def __init__(self, maxBytes):
+        self._blocks   = OrderedDict()
+        self._size     = 0
+        self._maxBytes = maxBytes
+        self._lock     = threading.Lock()
+        self.hits      = 0
+        self.misses    = 0
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def get(self, key):
+        with self._lock:
+            val = self._blocks.get(key, None)
+
+            if val is None:
+                self.misses += 1
+            else:
+                self.hits   += 1
+                self._blocks.move_to_end(key)
+
+        return val
+
+    def put(self, key, val):
+        data, _ = val
+
+        with self._lock:
+            if len(data) > self._maxBytes or key in self._blocks:
+                return
+
+            self._blocks[key]  = val
+            self._size        += len(data)
+
+            while self._size > self._maxBytes:
+                _, (old_data, _) = self._blocks.popitem(last=False)
+                self._size -= len(old_data)
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._size  = 0
+            self.hits   = 0
+            self.misses = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def maxBytes(self):
+        return self._maxBytes
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                "blocks"  : len(self._blocks),
+                "size"    : self._size,
+                "maxBytes": self._maxBytes,
+                "hits"    : self.hits,
+                "misses"  : self.misses
+            }
+
+class FileHandlePool():
+    # pool of read only file handles of a file. handles are taken by one
+    # stream at a time, so threads never share a file position.
+    # keeps at most maxHandles idle handles open.
+    def __init__(self, infile, maxHandles):
+        self._infile     = infile
+        self._maxHandles = maxHandles
+        self._handles    = []
+        self._lock       = threading.Lock()
+        self.opened      = 0
+
+    def acquire(self):
+        with self._lock:
+            if self._handles:
+                return self._handles.pop()
+            self.opened += 1
+
+        return open(self._infile, 'rb')
+
+    def release(self, filehandle):
+        with self._lock:
+            if len(self._handles) < self._maxHandles:
+                self._handles.append(filehandle)
+                return
+
+        filehandle.close()
+
+    def close(self):
+        with self._lock:
+            for filehandle in self._handles:
+                filehandle.close()
+            self._handles.clear()
+
+    def __len__(self):
+        return len(self._handles)
+
+# raw deflate decoders. each takes the deflate payload of a block and its
+# uncompressed size (ISIZE) and returns the uncompressed bytes.
+def inflateZlib(data, isize):
+    return zlib.decompress(data, -15, max(isize, 1))
+
+INFLATERS = {"zlib": inflateZlib}
+
+try:
+    from isal import isal_zlib
+    INFLATERS["isal"] = lambda data, isize: isal_zlib.decompress(data, -15, max(isize, 1))
+except ImportError:
+    pass
+
+try:
+    from zlib_ng import zlib_ng
+    INFLATERS["zlib-ng"] = lambda data, isize: zlib_ng.decompress(data, -15, max(isize, 1))
+except ImportError:
+    pass
+
+try:
+    import deflate as libdeflate
+    INFLATERS["libdeflate"] = lambda data, isize: libdeflate.deflate_decompress(bytes(data), isize)
+except ImportError:
+    pass
+
+INFLATER_PREFERENCE = ["libdeflate", "isal", "zlib-ng", "zlib"]
+
+_inflater  = inflateZlib
+_verifyCRC = False
+
+def setBlockDecoder(name=None, verifyCRC=None):
+    # name is one of INFLATERS or "auto" for the fastest one installed
+    global _inflater, _verifyCRC
+
+    if name == "auto":
+        name = next(n for n in INFLATER_PREFERENCE if n in INFLATERS)
+
+    if name is not None:
+        if name not in INFLATERS:
+            raise ValueError(f"block decoder {name} not available. available: {', '.join(sorted(INFLATERS))}")
+        _inflater = INFLATERS[name]
+        logger.info(f"block decoder {name}")
+
+    if verifyCRC is not None:
+        _verifyCRC = verifyCRC
+
+def getBlockDecoder():
+    name = next(n for n, f in INFLATERS.items() if f is _inflater)
+    return name, _verifyCRC
+
+def inflateBlock(blockdata):
+    # decompresses a whole BGZF block. the deflate payload sits between the
+    # header (12 bytes + XLEN) and the CRC32/ISIZE footer, so there is no
+    # need to go through the gzip module and its member parsing
+    if len(blockdata) < 18 or not blockdata[3] & 4: # no FEXTRA. not BGZF
+        return gzip.decompress(blockdata)
+
+    xlen,       = struct.unpack_from("<H" , blockdata, 10)
+    crc, isize  = struct.unpack_from("<II", blockdata, len(blockdata) - 8)
+
+    data        = _inflater(memoryview(blockdata)[12 + xlen:-8], isize)
+
+    if len(data) != isize:
+        raise IOError(f"block inflated to {len(data)} bytes. expected {isize}")
+
+    if _verifyCRC and zlib.crc32(data) != crc:
+        raise IOError("block CRC mismatch")
+
+    return data
+
+def fileFingerprint(infile):
+    st = os.stat(infile)
+    return (os.path.abspath(infile), st.st_size, st.st_mtime_ns)
+
+SOURCE_TAIL_SIZE = 64 * 1024
+
+def sourceFingerprint(infile):
+    # identifies the content of a data file for the indexes built from it:
+    # size, mtime and the sha256 of its first block and of its last 64kb
+    # (the last block and the EOF marker)
+    st = os.stat(infile)
+
+    with open(infile, "rb") as fhd:
+        block_len = readGzipHeader(fhd)
+        head      = fhd.read(block_len if block_len else SOURCE_TAIL_SIZE)
+
+        fhd.seek(max(0, st.st_size - SOURCE_TAIL_SIZE))
+        tail      = fhd.read()
+
+    return {
+        "size"    : st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "head"    : hashlib.sha256(head).hexdigest(),
+        "tail"    : hashlib.sha256(tail).hexdigest()
+    }
+
+def isSourceFresh(source, infile):
+    # whether infile still is the file source was taken from. same size and
+    # mtime is enough; if only the mtime changed (copied, touched) the block
+    # hashes decide. {"stale": True} marks an index taken from a .tbi older
+    # than infile, which is never fresh
+    if source is None:
+        return True # index written before fingerprints were stored
+
+    if source.get("stale", False):
+        return False
+
+    if not os.path.exists(infile):
+        logger.warning(f"data file {infile} not found. cannot verify the index against it")
+        return True
+
+    st = os.stat(infile)
+
+    if st.st_size != source["size"]:
+        return False
+
+    if st.st_mtime_ns == source["mtime_ns"]:
+        return True
+
+    current = sourceFingerprint(infile)
+
+    return current["head"] == source["head"] and current["tail"] == source["tail"]
+
+def isIndexOlder(index, infile):
+    # whether index (e.g. a .tbi written by another tool, without a source
+    # fingerprint) was last modified before the data file
+    if not os.path.exists(infile):
+        return False
+
+    return os.stat(index).st_mtime_ns < os.stat(infile).st_mtime_ns
+
+def readBlock(filehandle, real_pos, cache=None, fingerprint=None):
+    # returns the decompressed block starting at real_pos and its compressed
+    # length. returns (b"", -1) at the end of the file.
+    if cache is not None:
+        key = (fingerprint, real_pos)
+        val = cache.get(key)
+        if val is not None:
+            return val
+
+    filehandle.seek(real_pos, 0)
+
+    block_len = readGzipHeader(filehandle)
+
+    if block_len is False:
+        return b"", -1
+
+    if block_len is None:
+        raise IOError(f"invalid block length :: real_pos {real_pos}")
+
+    blockdata = filehandle.read(block_len)
+
+    assert len(blockdata) == block_len, f"block data has wrong size :: real_pos {real_pos} block_len {block_len}"
+
+    val = (inflateBlock(blockdata), block_len)
+
+    if cache is not None:
+        cache.put(key, val)
+
+    return val
+
 class openGzipStream():
-    def __init__(self, infile, realPos, bytesPos, asLine=False, chrom=None, begin=None, end=None):
-        logger.debug(f"infile {infile} realPos {realPos} bytesPos {bytesPos} asLine {asLine} chrom {chrom} begin {begin} end {end}")
-
-        self._infile    = infile
-        self._realPos   = realPos
-        self._bytesPos  = bytesPos
-        self._asLine    = asLine
-        self._chrom     = chrom
-        self._begin     = begin
-        self._end       = end
-        self._fhdf      = None
-        self._fhdz      = None
+    # iterates over the rows starting at the virtual file offset (realPos, bytesPos).
+    # if bytesPos is None, realPos is a block start which may not be aligned to a row.
+    # if endVirtual is given, stops at the first row starting at or after it.
+    # if pool is given, the file handle is taken from (and returned to) it.
+    # if readAhead > 0, a thread reads and inflates up to readAhead blocks
+    # ahead of the parser. waits counts how often each side had to wait.
+    # if columns (indexes) are given, rows are tuples of those columns only.
+    # if asRecord, rows are VcfRecord objects over the raw row bytes.
+    def __init__(self, infile, realPos, bytesPos, asLine=False, chrom=None, begin=None, end=None, cache=None, endVirtual=None, pool=None, readAhead=0, columns=None, asRecord=False):
+        logger.debug(f"infile {infile} realPos {realPos} bytesPos {bytesPos} asLine {asLine} chrom {chrom} begin {begin} end {end} endVirtual {endVirtual}")
+
+        self._infile      = infile
+        self._realPos     = realPos
+        self._bytesPos    = bytesPos
+        self._asLine      = asLine
+        self._chrom       = chrom
+        self._begin       = begin
+        self._end         = end
+        self._cache       = cache
+        self._endVirtual  = endVirtual
+        self._fingerprint = None
+        self._pool        = pool
+        self._fhdf        = None
+        self._readAhead   = readAhead
+        self._columns     = columns
+        self._asRecord    = asRecord
+        self._producer    = None
+        self._stop        = None
+        self.waits        = {"consumer": 0, "producer": 0}
+
+    def _iterBlocks(self):
+        if self._readAhead > 0:
+            return self._iterBlocksReadAhead()
+
+        return self._readBlocks()
+
+    def _readBlocks(self):
+        real_pos = self._realPos
+
+        while True:
+            data, block_len = readBlock(self._fhdf, real_pos, cache=self._cache, fingerprint=self._fingerprint)
+
+            if block_len < 0:
+                return
 
-    def __enter__(self):
-        self._fhdf = open(self._infile, 'rb')
-        
-        currPos = self._realPos
-        self._fhdf.seek(self._realPos)
-        
-        self._fhdz = gzip.open(self._fhdf, 'rb')
-
-        if self._bytesPos is not None and self._bytesPos > 0:
-            raise NotImplementedError("BytesPos Not implemented")
-            # block    = block[self._bytesPos:]
-            self._fhdz.seek(self._bytesPos)
-            block    = self._fhdz.read(BLOCK_SIZE-self._bytesPos).decode()
-        else:
-            block    = self._fhdz.read(BLOCK_SIZE).decode()
+            if len(data) > 0:
+                yield real_pos, data
+
+            real_pos += block_len
+
+    def _produce(self, blocks):
+        # producer thread. the end of the stream (or an error) is sent as None
+        try:
+            for val in self._readBlocks():
+                if not self._put(blocks, val):
+                    return
+
+        except Exception as e:
+            self._put(blocks, e)
+            return
 
+        self._put(blocks, None)
 
+    def _put(self, blocks, val):
+        if blocks.full():
+            self.waits["producer"] += 1
+
+        while not self._stop.is_set():
+            try:
+                blocks.put(val, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _iterBlocksReadAhead(self):
+        blocks         = queue.Queue(maxsize=self._readAhead)
+        self._stop     = threading.Event()
+        self._producer = threading.Thread(target=self._produce, args=(blocks,), daemon=True)
+        self._producer.start()
+
+        try:
+            while True:
+                if blocks.empty():
+                    self.waits["consumer"] += 1
+
+                val = blocks.get()
+
+                if val is None:
+                    return
+
+                if isinstance(val, Exception):
+                    raise val
+
+                yield val
+
+        finally:
+            self._stopReadAhead()
+
+    def _stopReadAhead(self):
+        if self._producer is not None:
+            self._stop.set()
+            self._producer.join()
+            self._producer = None
+
+    def __enter__(self):
+        # works on the raw bytes: line boundaries are found with find, only
+        # CHROM and POS are looked at to decide whether a row is wanted and
+        # only the rows which are yielded get decoded (and split)
+        self._fhdf = open(self._infile, 'rb') if self._pool is None else self._pool.acquire()
+
+        if self._cache is not None:
+            self._fingerprint = fileFingerprint(self._infile)
+
+        debug      = getLogLevel() == "DEBUG"
+        asLine     = self._asLine
+        begin      = self._begin
+        end        = self._end
+        filterPos  = begin is not None or end is not None
+        chromTab   = None if self._chrom is None else (self._chrom + "\t").encode()
+        endVirtual = self._endVirtual
         foundChrom = False
-        numCols    = None
-        lastLine   = None
-        prevLine   = None
-        prevCols   = None
-        rn         = -1
-        bn         = -1
-        while len(block) > 0:
-            bn       += 1
-            lines     = block.split("\n")
-            block     = self._fhdz.read(BLOCK_SIZE).decode()
-
-            if lastLine is not None:
-                lines[0] = lastLine + lines[0]
-                lastLine = None
-
-            if getLogLevel() == "DEBUG":
-                logger.debug(f"bn {bn} len(lines) {len(lines)} :: filter")
-            lines   = [line for line in lines if len(line) > 0 and line[0] != "#"] # filter out empty and comment lines 
-            columns = [line.split("\t") for line in lines]
-
-            if len(columns[-1]) != len(columns[1]): #incomplete last line
-                if getLogLevel() == "DEBUG":
-                    logger.debug(f"bn {bn} len(lines) {len(lines)} :: pop")
-                lastLine = lines.pop()
-                columns.pop()
-
-            if len(columns[0]) != len(columns[1]): #incomplete first line
-                if getLogLevel() == "DEBUG":
-                    logger.debug(f"bn {bn} len(lines) {len(lines)} :: shift")
-                lines   = lines[1:]
-                columns = columns[1:]
-
-            if numCols is None:
-                numCols = len(columns[0])
-
-            if self._chrom is not None:
-                if getLogLevel() == "DEBUG":
-                    logger.debug(f"bn {bn} len(lines) {len(lines)} :: chrom {self._chrom}")
-                lines   = [line for ln, line in enumerate(lines) if columns[ln][0] == self._chrom]
-                columns = [col  for col      in columns          if col[0]         == self._chrom]
-
-            if len(lines) == 0:
-                if getLogLevel() == "DEBUG":
-                    logger.debug(f"bn {bn} len(lines) == 0 :: return")
-                return
 
-            for ln, line in enumerate(lines):
-                cols = columns[ln]
-                if getLogLevel() == "DEBUG":
-                    logger.debug(f"bn {bn} len(lines) == {len(lines)} :: chrom {self._chrom} begin {self._begin} end {self._end} :: ln {ln}")
-
-                if self._begin is not None or self._end is not None:
-                    pos = int(cols[1])
-                    
-                    if self._begin is not None and pos < self._begin:
-                        if getLogLevel() == "DEBUG":
-                            logger.debug(f" pos {pos} < self._begin {self._begin}")
-                        continue
-
-                    if self._end is not None and pos >= self._end:
-                        if getLogLevel() == "DEBUG":
-                            logger.debug(f"pos {pos} >= self._end {self._end}")
+        columns    = self._columns
+        asRecord   = self._asRecord
+        if columns is not None:
+            # only the line up to the last requested column is decoded and split
+            maxCol   = max(columns)
+            getCols  = operator.itemgetter(*columns) if len(columns) > 1 else lambda cols: (cols[columns[0]],)
+
+        blocks     = self._iterBlocks()
+        curReal, block = next(blocks, (self._realPos, b""))
+        start      = 0
+
+        # to compute the virtual offset of a row: data from curOff onwards
+        # belongs to the block at curReal. data before curOff is the tail
+        # of the block at prevReal, shifted by prevShift.
+        curOff     = 0
+        prevReal   = curReal
+        prevShift  = 0
+
+        if self._bytesPos is not None:
+            # virtual file offset. bytesPos is the offset of the first row inside the block
+            start = self._bytesPos
+
+        elif self._realPos > 0:
+            # the first line may be the tail of a line which started in the previous block
+            eol  = block.find(b"\n")
+            eol2 = block.find(b"\n", eol + 1) if eol != -1 else -1
+            if eol2 != -1 and block.count(b"\t", 0, eol) != block.count(b"\t", eol + 1, eol2):
+                if debug:
+                    logger.debug(f"realPos {self._realPos} :: skipping incomplete first line")
+                start = eol + 1
+
+        while True:
+            eol = block.find(b"\n", start)
+
+            if eol == -1:
+                nextReal, nextBlock = next(blocks, (None, None))
+
+                if nextBlock is not None:
+                    if start >= curOff:
+                        prevReal  = curReal
+                        prevShift = start - curOff
+                    else: # row longer than a block
+                        prevShift += start
+
+                    block   = block[start:] + nextBlock
+                    curOff  = len(block) - len(nextBlock)
+                    curReal = nextReal
+                    start   = 0
+                    continue
+
+                if start >= len(block): # no dangling line
+                    return
+
+                eol = len(block)
+
+            lineStart = start
+            start     = eol + 1
+
+            if endVirtual is not None:
+                if lineStart >= curOff:
+                    lineVirtual = (curReal  << 16) | (lineStart - curOff)
+                else:
+                    lineVirtual = (prevReal << 16) | (lineStart + prevShift)
+
+                if lineVirtual >= endVirtual:
+                    if debug:
+                        logger.debug(f"lineVirtual {lineVirtual} >= endVirtual {endVirtual}")
+                    return
+
+            if eol == lineStart or block[lineStart] == 35: # filter out empty and comment (#) lines
+                continue
+
+            if chromTab is not None:
+                if not block.startswith(chromTab, lineStart, eol):
+                    if foundChrom:
+                        if debug:
+                            logger.debug(f"chrom {self._chrom} :: left chromosome")
                         return
+                    continue
+                foundChrom = True
 
-                    if self._asLine:
-                        yield line
-                    else:
-                        yield cols
+            if filterPos:
+                tab1 = block.find(b"\t", lineStart, eol)
+                tab2 = block.find(b"\t", tab1 + 1, eol)
 
-                else:
-                    if self._asLine:
-                        yield line
-                    else:
-                        yield cols
+                if tab1 == -1 or tab2 == -1:
+                    continue
+
+                pos  = int(block[tab1+1:tab2])
+
+                if begin is not None and pos < begin:
+                    continue
+
+                if end is not None and pos >= end:
+                    if debug:
+                        logger.debug(f"pos {pos} >= self._end {end}")
+                    return
+
+            if asRecord:
+                yield VcfRecord(block[lineStart:eol])
+                continue
+
+            if columns is not None:
+                cut = lineStart - 1
+                for _ in range(maxCol + 1):
+                    cut = block.find(b"\t", cut + 1, eol)
+                    if cut == -1:
+                        cut = eol
+                        break
+
+                cols = block[lineStart:cut].decode().split("\t")
+                if len(cols) <= maxCol: # short row (e.g. sites only): missing columns are None
+                    cols.extend([None] * (maxCol + 1 - len(cols)))
+
+                yield getCols(cols)
+                continue
+
+            line = block[lineStart:eol].decode()
+
+            if asLine:
+                yield line
+            else:
+                yield line.split("\t")
 
     def __exit__(self, type, value, traceback):
-        self._fhdz.close()
-        self._fhdf.close()
+        self._stopReadAhead()
+
+        if self._fhdf is not None:
+            if self._pool is None:
+                self._fhdf.close()
+            else:
+                self._pool.release(self._fhdf)
+            self._fhdf = None
 
 
 
@@ -193,6 +616,134 @@ def readGzipHeader(fp):
 
     return None
 
+def readBlockLength(buf, real_pos):
+    # same as readGzipHeader but over a buffer (bytes/mmap), without seeking.
+    # returns the BSIZE of the block starting at real_pos (header, data and
+    # footer included) or None if it is not a BGZF block
+    FEXTRA = 4
+
+    if buf[real_pos:real_pos+2] != GZIP_MAGIC:
+        raise IOError('Not a gzipped file (%r) :: real_pos %d' % (buf[real_pos:real_pos+2], real_pos))
+
+    (method, flag, extra_len) = struct.unpack_from("<BB6xH", buf, real_pos + 2)
+
+    if method != 8:
+        raise IOError('Unknown compression method')
+
+    if not flag & FEXTRA:
+        return None
+
+    extra_pos = real_pos + 12
+    extra_end = extra_pos + extra_len
+
+    while extra_pos + 4 <= extra_end:
+        (si1, si2, subfield_len) = struct.unpack_from("<ccH", buf, extra_pos)
+
+        if si1 == b"B" and si2 == b"C" and subfield_len == 2:
+            (block_len,) = struct.unpack_from("<H", buf, extra_pos + 4)
+            return block_len + 1
+
+        extra_pos += 4 + subfield_len
+
+    return None
+
+class BlockTable():
+    # real offset, compressed length (BSIZE) and uncompressed length (ISIZE)
+    # of every block in a BGZF file, EOF block included
+    __slots__ = ["reals", "lengths", "sizes"]
+
+    def __init__(self):
+        self.reals   = array("q")
+        self.lengths = array("i")
+        self.sizes   = array("i")
+
+    def __len__(self):
+        return len(self.reals)
+
+    def __getitem__(self, block_n):
+        return self.reals[block_n], self.lengths[block_n], self.sizes[block_n]
+
+    def __iter__(self):
+        return zip(self.reals, self.lengths, self.sizes)
+
+    def append(self, real_pos, block_len, block_size):
+        self.reals  .append(real_pos)
+        self.lengths.append(block_len)
+        self.sizes  .append(block_size)
+
+    def index(self, real_pos):
+        block_n = bisect.bisect_left(self.reals, real_pos)
+
+        if block_n == len(self.reals) or self.reals[block_n] != real_pos:
+            raise ValueError(f"no block starting at {real_pos}")
+
+        return block_n
+
+    @property
+    def compressedSize(self):
+        return sum(self.lengths)
+
+    @property
+    def uncompressedSize(self):
+        return sum(self.sizes)
+
+BGZF_MAX_DATA = 0xff00 # as bgzip: leaves room for incompressible data
+
+def bgzfCompress(data, level=6):
+    # data as BGZF blocks (gzip members with the BC extra subfield holding
+    # the block size) followed by the EOF marker block
+    res = []
+
+    for start in range(0, len(data), BGZF_MAX_DATA):
+        chunk      = data[start:start+BGZF_MAX_DATA]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        cdata      = compressor.compress(chunk) + compressor.flush()
+        block_size = 18 + len(cdata) + 8
+
+        res.append(struct.pack("<4BIBBH2sHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, b"BC", 2, block_size - 1))
+        res.append(cdata)
+        res.append(struct.pack("<II", zlib.crc32(chunk), len(chunk)))
+
+    res.append(BGZIP_EOF)
+
+    return b"".join(res)
+
+def scanBlocks(infile):
+    # walks the BGZF file reading only the gzip headers (BSIZE) and footers
+    # (ISIZE) over a mmap. nothing gets decompressed.
+    table = BlockTable()
+
+    with open(infile, "rb") as fhd:
+        file_size = os.fstat(fhd.fileno()).st_size
+
+        if file_size == 0:
+            return table
+
+        with mmap.mmap(fhd.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            real_pos = 0
+
+            while real_pos < file_size:
+                block_len = readBlockLength(buf, real_pos)
+
+                if block_len is None:
+                    raise IOError(f"invalid block length :: real_pos {real_pos}")
+
+                if real_pos + block_len > file_size:
+                    raise IOError(f"truncated block :: real_pos {real_pos} block_len {block_len} file size {file_size}")
+
+                (block_size,) = struct.unpack_from("<I", buf, real_pos + block_len - 4)
+
+                table.append(real_pos, block_len, block_size)
+
+                real_pos += block_len
+
+            if buf[file_size - len(BGZIP_EOF):] != BGZIP_EOF:
+                logger.warning(f"{infile} has no BGZF EOF block. file may be truncated")
+
+    logger.debug(f"scanBlocks :: {infile} {len(table):12,d} blocks")
+
+    return table
+
 def getBlock(filehandle, real_pos, block_len=None):
     filehandle.seek(real_pos, 0)
 
@@ -210,7 +761,7 @@ def getBlock(filehandle, real_pos, block_len=None):
     # logger.debug(f" block len   {block_len:12,d} {block_len//1024:12,d}kb {block_len//1024//1024:12,d}mb")
 
     blockdata = filehandle.read(block_len)
-    block     = gzip.decompress(blockdata)
+    block     = inflateBlock(blockdata)
     blocktext = block.decode()
 
     assert len(blockdata) == block_len
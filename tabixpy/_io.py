@@ -1,7 +1,20 @@
+import os
+import sys
 import gzip
+import mmap
 import json
 import struct
 import hashlib
+import itertools
+import threading
+import contextlib
+
+from array        import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from ._logger     import logger, getLogLevel
 from ._gzip       import GZIP_MAGIC
@@ -17,11 +30,13 @@ from ._consts import (
 from ._consts import (
     TABIXPY_FORMAT_NAME,
     TABIXPY_FORMAT_VER,
+    TABIXPY_FORMAT_VER_JSON,
     TABIXPY_EXTENSION
 )
 
 from ._consts import (
     VCFBGZ_FORMAT_VER,
+    VCFBGZ_FORMAT_VER_MMAP,
     VCFBGZ_FORMAT_NAME,
     VCFBGZ_EXTENSION,
     VCFBGZ_EOF
@@ -42,6 +57,44 @@ BIN_SIZES = [
     [ -2**63, 2**63, 'q' ], # long long          8
 ]
 
+# struct (standard sizes) to array and numpy types
+ARRAY_CODES = {
+    'B': 'B', 'b': 'b',
+    'H': 'H', 'h': 'h',
+    'L': 'I', 'l': 'i',
+    'Q': 'Q', 'q': 'q',
+}
+
+NUMPY_CODES = {
+    'B': '<u1', 'b': '<i1',
+    'H': '<u2', 'h': '<i2',
+    'L': '<u4', 'l': '<i4',
+    'Q': '<u8', 'q': '<i8',
+}
+
+def cumsumColumn(fmt, data):
+    # decodes a delta encoded TBK column into an array('q') of absolute values.
+    # the prefix sum runs in numpy, if available, or in C through accumulate.
+    # returns the values and their sum
+    if np is not None:
+        vals      = np.frombuffer(data, dtype=NUMPY_CODES[fmt]).astype(np.int64)
+        np.cumsum(vals, out=vals)
+        chrom_sum = int(vals.sum())
+        res       = array('q')
+        res.frombytes(vals.tobytes())
+        return res, chrom_sum
+
+    vals = array(ARRAY_CODES[fmt])
+    assert vals.itemsize == struct.calcsize(f"<{fmt}"), f"array type {ARRAY_CODES[fmt]} has size {vals.itemsize}"
+    vals.frombytes(data)
+
+    if sys.byteorder == "big":
+        vals.byteswap()
+
+    res = array('q', itertools.accumulate(vals))
+
+    return res, sum(res)
+
 def getByteSize(vals):
     for (min_val, max_val, code) in BIN_SIZES:
         if all([x >= min_val and x < max_val for x in vals]):
@@ -74,9 +127,79 @@ def getFilenames(infile):
 
     return ingz, inid, inbj, inbk
 
-def saveTabixPy(ingz, data, compress=COMPRESS):
+@contextlib.contextmanager
+def openReplace(outfile, compress=False):
+    # writes to a temporary file in the same folder and moves it over outfile
+    # once complete, so that readers which still have the old file open (or
+    # memory mapped) keep the old inode instead of seeing it rewritten. the
+    # gzip header holds the name of outfile, not the one of the temporary file
+    tmpfile = f"{outfile}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    try:
+        with open(tmpfile, "wb") as fhd:
+            if compress:
+                with gzip.GzipFile(filename=os.path.basename(outfile), fileobj=fhd, mode="wb") as gzfhd:
+                    yield gzfhd
+            else:
+                yield fhd
+
+        os.replace(tmpfile, outfile)
+
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+def readBed(filename):
+    # (chrom, begin, end) of each region of a BED file. BED coordinates are
+    # 0-based half open, converted to the 1-based half open [begin, end) of
+    # getChromosomeIter
+    opener = gzip.open if filename.endswith(".gz") else open
+
+    with opener(filename, "rt") as fhd:
+        for line in fhd:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+
+            cols = line.rstrip("\n").split("\t")
+
+            if len(cols) < 3:
+                raise ValueError(f"invalid BED line in {filename}: {line!r}")
+
+            yield cols[0], int(cols[1]) + 1, int(cols[2]) + 1
+
+TABIXPY_BLOCK_KEYS = ["block_len", "bin_pos", "first_pos", "last_pos"]
+
+def packTabixRef(ref):
+    # struct-of-arrays columns of a reference: bins, chunk virtual offsets,
+    # linear index virtual offsets and, if the index was read with the data
+    # file, the block information of each of them
+    if "columns" in ref:
+        return ref["columns"]
+
+    bins    = ref["bins"]
+    columns = {
+        "bins"    : array("I", [b["bin"    ] for b in bins]),
+        "n_chunks": array("i", [b["n_chunk"] for b in bins]),
+    }
+
+    nfos = {
+        "chunk_begin": [c for b in bins for c in b["chunks"]["chunk_begin"]],
+        "chunk_end"  : [c for b in bins for c in b["chunks"]["chunk_end"  ]],
+        "intvs"      : ref["intvs"],
+    }
+
+    for name, nfo in nfos.items():
+        columns[name] = array("Q", [(n["real"] << 16) | n["bytes"] for n in nfo])
+
+        if len(nfo) > 0 and all("block_len" in n for n in nfo):
+            for k in TABIXPY_BLOCK_KEYS:
+                columns[f"{name}_{k}"] = array("q", [n[k] for n in nfo])
+
+    return columns
+
+def saveTabixPy(ingz, data, compress=COMPRESS, version=TABIXPY_FORMAT_VER):
     data["__format_name__"] = TABIXPY_FORMAT_NAME
-    data["__format_ver__" ] = TABIXPY_FORMAT_VER
+    data["__format_ver__" ] = version
 
     outfileJ = ingz + TABIXPY_EXTENSION
 
@@ -87,8 +210,70 @@ def saveTabixPy(ingz, data, compress=COMPRESS):
         logger.debug("compressing")
         opener = gzip.open
 
-    with opener(outfileJ, "wt") as fhd:
-        json.dump(data, fhd, indent=1)
+    if version == TABIXPY_FORMAT_VER_JSON:
+        if any("bins" not in ref for ref in data["refs"]):
+            raise ValueError(f"{TABIXPY_FORMAT_NAME} version {TABIXPY_FORMAT_VER_JSON} needs the full index. read it from the TBI")
+
+        with opener(outfileJ, "wt") as fhd:
+            json.dump(data, fhd, indent=1)
+
+        return
+
+    assert version == TABIXPY_FORMAT_VER, f"version {version} == TABIXPY_FORMAT_VER {TABIXPY_FORMAT_VER}"
+
+    # binary layout: the TBK like preamble, a json header with everything
+    # but the bins, chunks and intervals, which follow as packed columns
+    refs_columns = [packTabixRef(ref) for ref in data["refs"]]
+    header       = {k: v for k, v in data.items() if k != "refs"}
+    header["refs"] = []
+
+    for ref, columns in zip(data["refs"], refs_columns):
+        ref_header = {k: v for k, v in ref.items() if k not in ("bins", "intvs", "columns")}
+        ref_header["columns"] = [[name, col.typecode, len(col)] for name, col in columns.items()]
+        header["refs"].append(ref_header)
+
+    headerJ = json.dumps(header).encode()
+
+    with opener(outfileJ, "wb") as fhd:
+        fhd.write(struct.pack(f"<q{len(TABIXPY_FORMAT_NAME)}sqq", len(TABIXPY_FORMAT_NAME), TABIXPY_FORMAT_NAME.encode(), version, len(headerJ)))
+        fhd.write(headerJ)
+
+        for columns in refs_columns:
+            for col in columns.values():
+                if sys.byteorder == "big":
+                    col = array(col.typecode, col)
+                    col.byteswap()
+                fhd.write(col.tobytes())
+
+def loadTabixPyColumns(fhd):
+    getter = genStructValueGetter(fhd)
+
+    (fmt_len,)           = getter("<q")
+    (fmt_nam, fmt_ver, lenHeaderJ) = getter(f"<{fmt_len}sqq")
+
+    assert fmt_nam.decode() == TABIXPY_FORMAT_NAME, f"fmt_nam {fmt_nam} == TABIXPY_FORMAT_NAME {TABIXPY_FORMAT_NAME}"
+    assert fmt_ver          == TABIXPY_FORMAT_VER , f"fmt_ver {fmt_ver} == TABIXPY_FORMAT_VER {TABIXPY_FORMAT_VER}"
+
+    data = json.loads(fhd.read(lenHeaderJ).decode())
+
+    for ref in data["refs"]:
+        columns = {}
+        for name, typecode, length in ref["columns"]:
+            col = array(typecode)
+            col.frombytes(fhd.read(length * col.itemsize))
+
+            if sys.byteorder == "big":
+                col.byteswap()
+
+            assert len(col) == length, f"column {name} of {ref['ref_name']} has {len(col)} values. expected {length}"
+
+            columns[name] = col
+
+        ref["columns"] = columns
+
+    assert len(fhd.read()) == 0
+
+    return data
 
 def loadTabixPy(ingz):
     (ingz, inid, inbj, inbk) = getFilenames(ingz)
@@ -96,32 +281,38 @@ def loadTabixPy(ingz):
     compressed = None
     with open(inbj, "rb") as fhd:
         firstChars = fhd.read(2)
-        if firstChars[0] == 123: # { 123
-            compressed = False
-        else:
-            assert firstChars == GZIP_MAGIC, firstChars
+        if firstChars[:2] == GZIP_MAGIC:
             compressed = True
+        else:
+            compressed = False
+
+    opener = gzip.open if compressed else open
+
+    with opener(inbj, "rb") as fhd:
+        is_json = fhd.read(1) == b"{" # { 123
 
-    is_compressed = "compressed json" if compressed else "json"
+    is_compressed = ("compressed " if compressed else "") + ("json" if is_json else "columns")
     logger.info(f"loading {inbj} as {is_compressed}")
 
     data = None
-    if compressed:
-        with gzip.open(inbj, "rb") as fhd:
-            data = json.load(fhd)
-    else:
-        with open(inbj, "rt") as fhd:
+    with opener(inbj, "rb") as fhd:
+        if is_json:
             data = json.load(fhd)
+        else:
+            data = loadTabixPyColumns(fhd)
 
     assert "__format_name__" in data
     assert "__format_ver__"  in data
 
     assert data["__format_name__"] == TABIXPY_FORMAT_NAME
-    assert data["__format_ver__" ] == TABIXPY_FORMAT_VER
+    assert data["__format_ver__" ] == (TABIXPY_FORMAT_VER_JSON if is_json else TABIXPY_FORMAT_VER)
 
     return data
 
 def saveVcfGzPy(filename, data, compress=COMPRESS):
+    if not compress:
+        return saveVcfGzPyMmap(filename, data)
+
     outfile = filename + VCFBGZ_EXTENSION
 
     logger.info(f" saving {outfile}")
@@ -132,7 +323,9 @@ def saveVcfGzPy(filename, data, compress=COMPRESS):
         "chroms"     : data["chroms"],
         "numCols"    : data["numCols"],
         "chromSizes" : data["chromSizes"],
-        "chromLength": data["chromLength"]
+        "chromLength": data["chromLength"],
+        "source"     : data.get("source", None),
+        "strayRows"  : data.get("strayRows", None)
     }
 
     headerJ     = json.dumps(header)
@@ -162,12 +355,10 @@ def saveVcfGzPy(filename, data, compress=COMPRESS):
         logger.debug(header_rev)
         assert header_rev == header_val
 
-    opener   = open
     if compress:
         logger.info(" compressing")
-        opener = gzip.open
 
-    with opener(outfile, 'wb') as fhd:
+    with openReplace(outfile, compress=compress) as fhd:
         fhd.write(header_dat)
 
         for lstK in ["realPositions", "firstPositions", "lastPositions", "numberRows"]:
@@ -212,16 +403,24 @@ def saveVcfGzPy(filename, data, compress=COMPRESS):
 
     return 
 
-def loadVcfGzPy(filename):
+class NoDigest():
+    # stands in for hashlib when the digest is not verified
+    def update(self, data):
+        pass
+
+def loadVcfGzPy(filename, verify=False):
+    # verify checks the sha256 digest of the whole index. off by default:
+    # the freshness of the index is checked against the source fingerprint
     indexFile = filename + VCFBGZ_EXTENSION
     logger.info(f" loading {indexFile}")
 
-    m = hashlib.sha256()
+    m = hashlib.sha256() if verify else NoDigest()
 
     compressed = None
     with open(indexFile, "rb") as fhd:
         firstChars = fhd.read( 8 + len(VCFBGZ_FORMAT_NAME) )
         compressed = None
+        fmt_ver    = None
 
         if firstChars[:2] == GZIP_MAGIC:
             compressed = True
@@ -235,12 +434,16 @@ def loadVcfGzPy(filename):
             
             if fmt == VCFBGZ_FORMAT_NAME:
                 compressed = False
+                (fmt_ver,) = struct.unpack("<q", fhd.read(8))
             else:
                 raise ValueError(f"not a valid uncompressed file. invalid magic header: {fmt}. expected {GZIP_MAGIC} OR {VCFBGZ_FORMAT_NAME}")
 
         if compressed is None:
             raise ValueError(f"not a valid uncompressed file. invalid magic header: {fmt}. expected {GZIP_MAGIC} OR {VCFBGZ_FORMAT_NAME}")
 
+    if fmt_ver == VCFBGZ_FORMAT_VER_MMAP:
+        return loadVcfGzPyMmap(filename, verify=verify)
+
     opener   = open
     if compressed:
         logger.info(" decompressing")
@@ -290,22 +493,20 @@ def loadVcfGzPy(filename):
 
                 ((fmt,), d) = getter(f"<c")
                 m.update(d)
+                fmt = fmt.decode()
                 # logger.info(f"cdsum {cdsum} fmt {fmt}")
 
-                (chrom_data, d) = getter(f"<{chromSize}{fmt.decode()}")
+                d = fhd.read(chromSize * struct.calcsize(f"<{fmt}"))
                 m.update(d)
 
-                chrom_data = list(chrom_data)
-                # logger.info(f"chrom_data {chrom_data[:10]} {chrom_data[-10:]}")
-                for c in range(1,len(chrom_data)):
-                    chrom_data[c] = chrom_data[c] + chrom_data[c-1]
+                chrom_data, chrom_sum = cumsumColumn(fmt, d)
                 # logger.info(f"chrom_data {chrom_data[:10]} {chrom_data[-10:]}")
 
                 if cdsum == 0: #pypy
-                    assert sum(chrom_data) == -1, f"sum(chrom_data) {sum(chrom_data)} == cdsum {cdsum}"
+                    assert chrom_sum == -1, f"sum(chrom_data) {chrom_sum} == cdsum {cdsum}"
 
                 else:
-                    assert sum(chrom_data) == cdsum, f"sum(chrom_data) {sum(chrom_data)} == cdsum {cdsum}"
+                    assert chrom_sum == cdsum, f"sum(chrom_data) {chrom_sum} == cdsum {cdsum}"
 
                 header[lstK].append(chrom_data)
 
@@ -316,7 +517,8 @@ def loadVcfGzPy(filename):
         ((digestHex, ), _)  = getter(f"<{digestLen}s")
         digestHex = digestHex.decode()
         logger.info(f"digestHex  {digestHex}")
-        assert digestHex == m.hexdigest()
+        if verify:
+            assert digestHex == m.hexdigest(), f"digest {digestHex} == {m.hexdigest()}"
 
         eof = fhd.read(len(VCFBGZ_EOF))
         
@@ -325,3 +527,146 @@ def loadVcfGzPy(filename):
         assert len(fhd.read()) == 0
 
     return header
+
+class TBKColumn():
+    # one column (e.g. realPositions) of a memory mapped TBK file. behaves as
+    # a list of per chromosome int64 sequences. a chromosome is only paged in
+    # when it is first accessed.
+    __slots__ = ["_buf", "_offsets", "_sizes", "_cols"]
+
+    def __init__(self, buf, offsets, sizes):
+        self._buf     = buf
+        self._offsets = offsets
+        self._sizes   = sizes
+        self._cols    = [None] * len(sizes)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self._sizes)
+
+        col = self._cols[idx]
+
+        if col is None:
+            start = self._offsets[idx]
+            end   = start + 8 * self._sizes[idx]
+
+            if sys.byteorder == "little":
+                col = memoryview(self._buf)[start:end].cast("q")
+            else:
+                col = array("q", self._buf[start:end])
+                col.byteswap()
+
+            self._cols[idx] = col
+
+        return col
+
+    def __iter__(self):
+        for idx in range(len(self._sizes)):
+            yield self[idx]
+
+    def __eq__(self, other):
+        return len(self) == len(other) and all(list(a) == list(b) for a, b in zip(self, other))
+
+def saveVcfGzPyMmap(filename, data):
+    # uncompressed TBK layout. the (v1) preamble and json header are followed
+    # by a table with the offset of every column of every chromosome and the
+    # columns themselves, as 8 byte aligned little endian int64, so that the
+    # file can be memory mapped and each chromosome paged in on demand.
+    outfile = filename + VCFBGZ_EXTENSION
+
+    logger.info(f" saving {outfile} (mmap)")
+
+    lstKs       = ["realPositions", "firstPositions", "lastPositions", "numberRows"]
+    chromSizes  = data["chromSizes"]
+    header      = {
+        "chroms"     : data["chroms"],
+        "numCols"    : data["numCols"],
+        "chromSizes" : data["chromSizes"],
+        "chromLength": data["chromLength"],
+        "source"     : data.get("source", None),
+        "strayRows"  : data.get("strayRows", None)
+    }
+
+    headerJ     = json.dumps(header).encode()
+    header_fmt  = f"<q{len(VCFBGZ_FORMAT_NAME)}sqq{len(headerJ)}s"
+    header_dat  = struct.pack(header_fmt, len(VCFBGZ_FORMAT_NAME), VCFBGZ_FORMAT_NAME.encode(), VCFBGZ_FORMAT_VER_MMAP, len(headerJ), headerJ)
+    header_dat += b"\x00" * (-len(header_dat) % 8)
+
+    offsets     = []
+    offset      = len(header_dat) + 8 * len(lstKs) * len(chromSizes)
+    for lstK in lstKs:
+        for chromSize in chromSizes:
+            offsets.append(offset)
+            offset += 8 * chromSize
+
+    m = hashlib.sha256()
+
+    with openReplace(outfile) as fhd:
+        for dat in (header_dat, struct.pack(f"<{len(offsets)}q", *offsets)):
+            fhd.write(dat)
+            m.update(dat)
+
+        for lstK in lstKs:
+            logger.info(f" writing {lstK:16s} - {data['chromLength']:18,d}")
+            for chrom_data in data[lstK]:
+                col = array("q", chrom_data)
+
+                if sys.byteorder == "big":
+                    col.byteswap()
+
+                dat = col.tobytes()
+                fhd.write(dat)
+                m.update(dat)
+
+        digestHex = m.hexdigest().encode()
+        fhd.write(struct.pack(f"<q{len(digestHex)}s", len(digestHex), digestHex))
+        fhd.write(VCFBGZ_EOF)
+
+        logger.info(digestHex.decode())
+
+def loadVcfGzPyMmap(filename, verify=False):
+    # constant time: only the header and offset table are read. the columns
+    # are TBKColumn views over the memory map
+    indexFile = filename + VCFBGZ_EXTENSION
+    logger.info(f" loading {indexFile} (mmap)")
+
+    with open(indexFile, "rb") as fhd:
+        buf = mmap.mmap(fhd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    lstKs = ["realPositions", "firstPositions", "lastPositions", "numberRows"]
+
+    (fmt_len,)       = struct.unpack_from("<q", buf, 0)
+    assert fmt_len == len(VCFBGZ_FORMAT_NAME), f"fmt_len {fmt_len} == len(VCFBGZ_FORMAT_NAME) {len(VCFBGZ_FORMAT_NAME)}"
+
+    (fmt_nam, fmt_ver, lenHeaderJ) = struct.unpack_from(f"<{fmt_len}sqq", buf, 8)
+    assert fmt_nam.decode() == VCFBGZ_FORMAT_NAME, f"fmt_nam {fmt_nam} == VCFBGZ_FORMAT_NAME {VCFBGZ_FORMAT_NAME}"
+    assert fmt_ver          == VCFBGZ_FORMAT_VER_MMAP, f"fmt_ver {fmt_ver} == VCFBGZ_FORMAT_VER_MMAP {VCFBGZ_FORMAT_VER_MMAP}"
+
+    header_pos  = 8 + fmt_len + 8 + 8
+    header      = json.loads(buf[header_pos:header_pos+lenHeaderJ].decode())
+    logger.debug(f" header     {header}")
+
+    chromSizes  = header["chromSizes"]
+    table_pos   = header_pos + lenHeaderJ
+    table_pos  += -table_pos % 8
+    offsets     = struct.unpack_from(f"<{len(lstKs) * len(chromSizes)}q", buf, table_pos)
+
+    for lstN, lstK in enumerate(lstKs):
+        header[lstK] = TBKColumn(buf, offsets[lstN*len(chromSizes):(lstN+1)*len(chromSizes)], chromSizes)
+
+    data_end = offsets[-1] + 8 * chromSizes[-1] if len(chromSizes) > 0 else table_pos
+    (digestLen,) = struct.unpack_from("<q", buf, data_end)
+    (digestHex,) = struct.unpack_from(f"<{digestLen}s", buf, data_end + 8)
+    eof          = buf[data_end + 8 + digestLen:]
+
+    assert eof == VCFBGZ_EOF
+
+    if verify:
+        m = hashlib.sha256()
+        m.update(buf[:data_end])
+        assert digestHex.decode() == m.hexdigest()
+
+    return header
@@ -58,9 +58,13 @@ parser.add_argument(
     '-noc'               if tabixpy.TabixDefaults.COMPRESS else '-c',
     dest="compress",
     action='store_false' if tabixpy.TabixDefaults.COMPRESS else 'store_true',
-    help  =f'Compress TBJ file. default: {tabixpy.TabixDefaults.COMPRESS}'
+    help  =f'Compress TBJ/TBK file. Uncompressed TBK files are memory mapped. default: {tabixpy.TabixDefaults.COMPRESS}'
 )
 
+parser.add_argument('--workers', '-w', dest="workers", type=int, default=tabixpy.TabixDefaults.WORKERS, help=f'Number of processes used to build TBK indexes. 0 uses all cpus. default: {tabixpy.TabixDefaults.WORKERS}')
+
+parser.add_argument('--tbi', '-t', dest="tbi", action='store_true', help='Also write the tabix index (.tbi) while building a TBK index. default: False')
+
 parser.add_argument('--verbose', '-v', action='count', default=0, help='Verbosity level. accepts multiple.')
 
 fmts = list(tabixpy.Formats.__members__.keys())
@@ -76,6 +80,8 @@ def main():
     infile      = parsed.infile[0]
     compress    = parsed.compress
     overwrite   = parsed.overwrite
+    workers     = parsed.workers
+    tbi         = parsed.tbi
     description = parsed.description
     license     = parsed.license
 
@@ -87,13 +93,15 @@ def main():
     print(f"""
 compress  = {compress}
 overwrite = {overwrite}
+workers   = {workers}
+tbi       = {tbi}
 verbosity = {verbosity}
 indexType = {indexType}
 infile    = {infile}
 """)
 
     tabix  = tabixpy.Tabix(infile, indexType=indexType, logLevel=verbosity)
-    tabix.create(overwrite=overwrite, compress=compress)
+    tabix.create(overwrite=overwrite, compress=compress, workers=workers, tbi=tbi)
 
 if __name__ == "__main__":
     main()
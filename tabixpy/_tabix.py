@@ -1,8 +1,11 @@
 import os
 import struct
 import json
+import bisect
 
-from ._gzip       import gzip, getBlock, EOF
+from array        import array
+
+from ._gzip       import gzip, getBlock, EOF, BlockCache, sourceFingerprint, isIndexOlder, bgzfCompress
 from ._io         import getFilenames, genStructValueGetter
 from ._logger     import logger, getLogLevel
 from ._consts     import (
@@ -10,7 +13,10 @@ from ._consts     import (
     TABIX_MAGIC,
     TABIX_FILE_BYTES_MASK,
     TABIX_BLOCK_BYTES_MASK,
-    TABIX_MAX_BIN
+    TABIX_MAX_BIN,
+    TABIX_PSEUDO_BIN,
+    TABIX_MAX_POS,
+    BLOCK_CACHE_SIZE
 )
 
 def reg2bin(begPos, endPos):
@@ -51,10 +57,94 @@ def reg2bins(rbeg, rend):
             res[i] = k
             i+=1
 
-    return i; # #elements in list[]
+    return res[:i]
 
-def parseBlock(block, bytes_pos, chrom):
-    bin_pos        = -1
+class RefIndex():
+    # immutable, array backed view of the binning and linear index of a
+    # reference, built once after loading so that queries never touch (or
+    # modify) the nested dicts of the TBJ structure
+    __slots__ = ["ref_n", "ref_name", "ioffs", "bins"]
+
+    def __init__(self, ref):
+        self.ref_n    = ref["ref_n"   ]
+        self.ref_name = ref["ref_name"]
+        self.bins     = {}
+
+        if "columns" in ref: # TBJ columns
+            columns    = ref["columns"]
+            self.ioffs = columns["intvs"]
+            chunk_n    = 0
+
+            for bin_v, n_chunk in zip(columns["bins"], columns["n_chunks"]):
+                self._addBin(bin_v, zip(columns["chunk_begin"][chunk_n:chunk_n+n_chunk], columns["chunk_end"][chunk_n:chunk_n+n_chunk]))
+                chunk_n += n_chunk
+
+        else:
+            self.ioffs = array("Q", [(intv["real"] << 16) | intv["bytes"] for intv in ref["intvs"]])
+
+            for bin_data in ref["bins"]:
+                self._addBin(bin_data["bin"], (
+                    ((chk_beg["real"] << 16) | chk_beg["bytes"], (chk_end["real"] << 16) | chk_end["bytes"])
+                    for chk_beg, chk_end in zip(bin_data["chunks"]["chunk_begin"], bin_data["chunks"]["chunk_end"])
+                ))
+
+    def _addBin(self, bin_v, chunks):
+        chunks = sorted(chunks)
+
+        self.bins[bin_v] = (
+            array("Q", [c[0] for c in chunks]),
+            array("Q", [c[1] for c in chunks])
+        )
+
+def buildRefIndexes(data):
+    return [RefIndex(ref) for ref in data["refs"]]
+
+def getChunks(ref_index, begin=None, end=None):
+    # virtual offset ranges [beg, end) which may contain the rows of ref with
+    # begin <= POS < end. POS is 1-based, bins and windows are 0-based.
+    # positions after TABIX_MAX_POS can not be indexed
+    rbeg  = 0             if begin is None else min(max(begin - 1, 0), TABIX_MAX_POS)
+    rend  = TABIX_MAX_POS if end   is None else min(end - 1, TABIX_MAX_POS)
+
+    if rend <= rbeg:
+        return []
+
+    # linear index: rows overlapping the region can not start before the
+    # first row of the window containing rbeg
+    ioffs   = ref_index.ioffs
+    min_off = ioffs[min(rbeg >> 14, len(ioffs) - 1)]
+
+    chunks = []
+    for bin_v in reg2bins(rbeg, rend):
+        bin_chunks = ref_index.bins.get(bin_v, None)
+
+        if bin_chunks is None:
+            continue
+
+        chk_begs, chk_ends = bin_chunks
+
+        # chunks of a bin are sorted. skip the ones ending before min_off
+        for chunk_n in range(bisect.bisect_right(chk_ends, min_off), len(chk_ends)):
+            chunks.append((chk_begs[chunk_n], chk_ends[chunk_n]))
+
+    return mergeChunks(chunks)
+
+def mergeChunks(chunks):
+    # sorts chunks and merges the ones which overlap or are adjacent or
+    # which end and start in the same block
+    chunks = sorted(chunks)
+    merged = []
+
+    for chk_beg, chk_end in chunks:
+        if len(merged) > 0 and (chk_beg <= merged[-1][1] or chk_beg >> 16 == merged[-1][1] >> 16):
+            if chk_end > merged[-1][1]:
+                merged[-1][1] = chk_end
+        else:
+            merged.append([chk_beg, chk_end])
+
+    return [tuple(m) for m in merged]
+
+def parseBlockRows(block, chrom):
     first_pos      = -1
     last_pos       = -1
     first_chrom    = None
@@ -62,7 +152,6 @@ def parseBlock(block, bytes_pos, chrom):
     num_rows       = -1
 
     assert len(block) > 0, f"empty block '{block}'"
-    assert bytes_pos  < len(block)
 
     first_row = None
     last_row  = None
@@ -72,24 +161,24 @@ def parseBlock(block, bytes_pos, chrom):
     if num_rows == 0:
         if getLogLevel() == "DEBUG":
             logger.debug(f"num_rows {num_rows} == 0")
-        return -1, -1, -1, None, -1, -1
+        return -1, -1, None, -1, -1
 
     if num_rows < 3:
         if getLogLevel() == "DEBUG":
             logger.debug(f"num_rows {num_rows} < 3")
-        return -1, -1, -1, None, -1, -1
+        return -1, -1, None, -1, -1
 
     rows       = [row for row in rows if len(row) == len(rows[1])]
 
     if num_rows == 0:
         if getLogLevel() == "DEBUG":
             logger.debug(f"num_rows {num_rows} == 0")
-        return -1, -1, -1, None, -1, -1
+        return -1, -1, None, -1, -1
 
     if num_rows < 3:
         if getLogLevel() == "DEBUG":
             logger.debug(f"num_rows {num_rows} < 3")
-        return -1, -1, -1, None, -1, -1
+        return -1, -1, None, -1, -1
     
     # rows_group = list(set([row[0] for row in rows]))
     # rows_data  = []
@@ -103,12 +192,12 @@ def parseBlock(block, bytes_pos, chrom):
     if num_rows == 0:
         if getLogLevel() == "DEBUG":
             logger.debug(f"num_rows {num_rows} == 0")
-        return -1, -1, -1, None, -1, -1
+        return -1, -1, None, -1, -1
 
     if num_rows < 3:
         if getLogLevel() == "DEBUG":
             logger.debug(f"num_rows {num_rows} < 3")
-        return -1, -1, -1, None, -1, -1
+        return -1, -1, None, -1, -1
 
     elif num_rows == 1:
         first_row = rows[0]
@@ -161,13 +250,13 @@ def parseBlock(block, bytes_pos, chrom):
     len_last_cols  = len(last_cols)
 
     if len_first_cols < 2:
-        return -1, -1, -1, None, -1, -1
+        return -1, -1, None, -1, -1
 
     if len_first_cols < 2:
-        return -1, -1, -1, None, -1, -1
+        return -1, -1, None, -1, -1
 
     if len_first_cols < len_last_cols:
-        return -1, -1, -1, None, -1, -1
+        return -1, -1, None, -1, -1
 
     assert len_first_cols >= len_last_cols, f"{len_first_cols} >= {len_last_cols}\n{len_first_cols} {first_cols}\n{len_last_cols} {last_cols}"
     assert len_first_cols >= 2            , f"{len_first_cols} >= 2\n{len_first_cols} {first_cols}"
@@ -190,6 +279,11 @@ def parseBlock(block, bytes_pos, chrom):
     except:
         raise ValueError(f"invalid positions {last_pos} :: {last_row}")
 
+    return first_pos, last_pos, first_chrom, len_first_cols, num_rows
+
+def parseBinPos(block, bytes_pos, len_first_cols):
+    bin_pos      = -1
+
     bin_reg      = block[bytes_pos:].split("\n")[0]
     bin_cols     = bin_reg.split("\t")
     len_bin_cols = len(bin_cols)
@@ -197,7 +291,7 @@ def parseBlock(block, bytes_pos, chrom):
         bin_chrom  = bin_cols[0]
         bin_pos    = bin_cols[1]
         
-        assert len_bin_cols == len_first_cols, f"len(bin_cols) {len_bin_cols} == len(first_cols) {len_first_cols} :: bytes_pos {bytes_pos} chrom {chrom}\nblock[         :100] {block[:100]}\nblock[bytes_pos:   ] {block[bytes_pos:bytes_pos+100]}"
+        assert len_bin_cols == len_first_cols, f"len(bin_cols) {len_bin_cols} == len(first_cols) {len_first_cols} :: bytes_pos {bytes_pos}\nblock[         :100] {block[:100]}\nblock[bytes_pos:   ] {block[bytes_pos:bytes_pos+100]}"
 
         try:
             bin_pos    = int(bin_pos)
@@ -206,16 +300,90 @@ def parseBlock(block, bytes_pos, chrom):
             logger.error(bin_reg)
             raise
 
-        assert len_bin_cols >= len_last_cols, f"{len_bin_cols} == {len_last_cols}\n{len_bin_cols} {bin_cols}\n{len_last_cols} {last_cols}"
+    return bin_pos
+
+def parseBlock(block, bytes_pos, chrom):
+    assert len(block) > 0, f"empty block '{block}'"
+    assert bytes_pos  < len(block)
+
+    first_pos, last_pos, first_chrom, len_first_cols, num_rows = parseBlockRows(block, chrom)
+
+    if first_chrom is None:
+        return -1, -1, -1, None, -1, -1
+
+    bin_pos = parseBinPos(block, bytes_pos, len_first_cols)
 
     return bin_pos, first_pos, last_pos, first_chrom, len_first_cols, num_rows
 
-def getPos(filehandle, real_pos, bytes_pos, chrom):
+class BlockPosCache():
+    # block level cache used while converting a TBI, keyed by real offset.
+    # every block is decompressed at most once (while its text stays in the
+    # bounded LRU) and its rows parsed at most once per chromosome.
+    def __init__(self, maxBytes=BLOCK_CACHE_SIZE):
+        self._texts         = BlockCache(maxBytes)
+        self._eofs          = set()
+        self._rows          = {}
+        self._pos           = {}
+        self.requests       = 0
+        self.decompressions = 0
+
+    @property
+    def saved(self):
+        return self.requests - self.decompressions
+
+    def getPos(self, real_pos, bytes_pos, chrom):
+        self.requests += 1
+        return self._pos.get((real_pos, bytes_pos, chrom), None)
+
+    def putPos(self, real_pos, bytes_pos, chrom, res):
+        self._pos[(real_pos, bytes_pos, chrom)] = res
+
+    def getBlock(self, filehandle, real_pos):
+        if real_pos in self._eofs:
+            return EOF(), -1
+
+        val = self._texts.get(real_pos)
+
+        if val is None:
+            self.decompressions += 1
+
+            val = getBlock(filehandle, real_pos)
+
+            if isinstance(val[0], EOF):
+                self._eofs.add(real_pos)
+            else:
+                self._texts.put(real_pos, val)
+
+        return val
+
+    def parseBlock(self, real_pos, block, bytes_pos, chrom):
+        assert bytes_pos  < len(block)
+
+        rows = self._rows.get((real_pos, chrom), None)
+        if rows is None:
+            rows = parseBlockRows(block, chrom)
+            self._rows[(real_pos, chrom)] = rows
+
+        first_pos, last_pos, first_chrom, len_first_cols, num_rows = rows
+
+        if first_chrom is None:
+            return -1, -1, -1, None, -1, -1
+
+        bin_pos = parseBinPos(block, bytes_pos, len_first_cols)
+
+        return bin_pos, first_pos, last_pos, first_chrom, len_first_cols, num_rows
+
+def getPos(filehandle, real_pos, bytes_pos, chrom, cache=None):
     # logger.debug(f"getPos :: real_pos {real_pos} bytes_pos {bytes_pos} chrom {chrom}")
 
     if filehandle is None:
         raise ValueError("Filehandle is empty")
 
+    if cache is not None:
+        res = cache.getPos(real_pos, bytes_pos, chrom)
+        if res is not None:
+            return res
+
     bin_pos    = -1
     first_pos  = -1
     last_pos   = -1
@@ -225,22 +393,34 @@ def getPos(filehandle, real_pos, bytes_pos, chrom):
     num_cols   = -1
     num_rows   = -1
 
-    block, block_len = getBlock(filehandle, real_pos)
+    if cache is None:
+        block, block_len = getBlock(filehandle, real_pos)
+    else:
+        block, block_len = cache.getBlock(filehandle, real_pos)
 
     if isinstance(block, EOF):
-        return bin_pos, first_pos, last_pos, block_len, block_size, chrom_name, num_cols, num_rows 
+        res = bin_pos, first_pos, last_pos, block_len, block_size, chrom_name, num_cols, num_rows
+
+    else:
+        assert len(block) > 0, f"got empty block {real_pos}"
 
-    assert len(block) > 0, f"got empty block {real_pos}"
+        block_size       = len(block)
 
-    block_size       = len(block)
+        if cache is None:
+            bin_pos, first_pos, last_pos, chrom_name, num_cols, num_rows = parseBlock(block, bytes_pos, chrom)
+        else:
+            bin_pos, first_pos, last_pos, chrom_name, num_cols, num_rows = cache.parseBlock(real_pos, block, bytes_pos, chrom)
 
-    bin_pos, first_pos, last_pos, chrom_name, num_cols, num_rows = parseBlock(block, bytes_pos, chrom)
+        res = bin_pos, first_pos, last_pos, block_len, block_size, chrom_name, num_cols, num_rows
 
-    return bin_pos, first_pos, last_pos, block_len, block_size, chrom_name, num_cols, num_rows
+    if cache is not None:
+        cache.putPos(real_pos, bytes_pos, chrom, res)
 
-def getPosData(bin_n, chunk_n, inf, real_pos, bytes_pos, chrom):
+    return res
+
+def getPosData(bin_n, chunk_n, inf, real_pos, bytes_pos, chrom, cache=None):
     if inf is not None:
-        bin_pos, first_pos, last_pos, block_len, _, _, _, _ = getPos(inf, real_pos, bytes_pos, chrom)
+        bin_pos, first_pos, last_pos, block_len, _, _, _, _ = getPos(inf, real_pos, bytes_pos, chrom, cache=cache)
 
         chunk_nfo = {
             "bin_n": bin_n,
@@ -263,7 +443,241 @@ def getPosData(bin_n, chunk_n, inf, real_pos, bytes_pos, chrom):
 
     return chunk_nfo
 
-def readTabix(infile):
+def getPosDataLazy(inf, chunk_nfo, chrom):
+    # block information (block_len, bin_pos, first_pos, last_pos) of a chunk
+    # read without the data file (lazy). does not modify chunk_nfo
+    if "block_len" in chunk_nfo:
+        return chunk_nfo
+
+    nfo = getPosData(chunk_nfo["bin_n"], chunk_nfo["chunk_n"], inf, chunk_nfo["real"], chunk_nfo["bytes"], chrom)
+
+    return nfo
+
+def getLastBlock(inf, ref_name, last_bin, cache=None):
+    # the last chunk of a reference may end before its last block.
+    # follows the blocks after it while they still have rows of ref_name
+    last_bin_pos, last_first_pos, last_last_pos, last_block_len = [last_bin.get(k, None) for k in ['bin_pos', 'first_pos', 'last_pos', 'block_len']]
+
+    lastReal     = last_bin["real"] + last_block_len
+    chrom_name   = ref_name
+    extra_blocks = []
+    e            = 0
+
+    while last_block_len > 0 and last_last_pos > 0 and chrom_name == ref_name:
+        chrom_name = ref_name
+        # last_bin_pos, last_first_pos, last_last_pos, last_block_len, _, _, _, _ = getPos(inf, lastReal, 0, ref_name)
+        last_nfo       = getPosData(-1, -1, inf, lastReal, 0, ref_name, cache=cache)
+
+        last_bin_pos, last_first_pos, last_last_pos, last_block_len = [last_nfo[k] for  k in ["bin_pos", "first_pos", "last_pos", "block_len"]]
+
+        if last_block_len > 0 and last_last_pos > 0:# and chrom_name == ref_name:
+            logger.debug(f"TAIL {e} chrom_name {chrom_name} last_bin_pos {last_bin_pos:12,d} last_first_pos {last_first_pos:12,d} last_last_pos {last_last_pos:12,d} last_block_len {last_block_len:12,d}")
+            extra_blocks.append(last_nfo)
+        lastReal += last_block_len
+        e += 1
+
+    if len(extra_blocks) > 0:
+        return extra_blocks[-1]
+
+    return last_bin
+
+def parseTabixRow(line):
+    # (chrom, beg, end) of a VCF row as tabix -p vcf: 0-based beg and the
+    # end of REF, or INFO END if given
+    cols  = line.split(b"\t", 8)
+    beg   = int(cols[1]) - 1
+    end   = beg + len(cols[3])
+
+    if len(cols) > 7:
+        info = cols[7]
+        if info.startswith(b"END=") or b";END=" in info:
+            end_s = info[info.find(b"END=") + 4:].split(b";", 1)[0]
+            if end_s.isdigit() and int(end_s) > beg:
+                end = int(end_s)
+
+    return cols[0].decode(), beg, end
+
+def blockRows(data):
+    # rows of a decompressed block for the tabix index. returns the bytes up
+    # to the first newline (the end of a row started in an earlier block, or
+    # a whole row), the rows starting after it as (start, end, chrom, beg, end)
+    # with start and end as offsets in the block, and the bytes after the
+    # last newline (a row continued in the next block).
+    # head is None if the block has no newline at all.
+    eol = data.find(b"\n")
+
+    if eol == -1:
+        return None, [], data
+
+    head  = data[:eol + 1]
+    rows  = []
+    start = eol + 1
+
+    while True:
+        eol = data.find(b"\n", start)
+
+        if eol == -1:
+            break
+
+        if eol > start and data[start] != 35: # empty and comment (#) lines
+            rows.append((start, eol + 1) + parseTabixRow(data[start:eol]))
+
+        start = eol + 1
+
+    return head, rows, data[start:]
+
+def blockRowStarts(block):
+    # rows of a decompressed block for counting. returns the text up to the
+    # first newline (the end of a row started in an earlier block, or a
+    # whole row), [chrom, count] runs of the rows starting after it and the
+    # text after the last newline (a row continued in the next block).
+    # head is None if the block has no newline at all.
+    eol = block.find("\n")
+
+    if eol == -1:
+        return None, [], block
+
+    last = block.rfind("\n")
+    runs = []
+
+    if last > eol:
+        first_tab = block.find("\t", eol + 1, last)
+        last_beg  = block.rfind("\n", 0, last) + 1
+        last_tab  = block.find("\t", last_beg, last)
+        chrom     = block[eol + 1:first_tab]
+
+        # rows are sorted. if the first and last row are of the same
+        # chromosome, so are all the rows in between
+        if first_tab > eol + 1 and block[eol + 1] != "#" and "\n" not in chrom and last_tab != -1 and block[last_beg:last_tab] == chrom:
+            return block[:eol], [[chrom, block.count("\n" + chrom + "\t", eol, last)]], block[last + 1:]
+
+        for row in block[eol + 1:last].split("\n"):
+            tab = row.find("\t")
+
+            if tab <= 0 or row[0] == "#": # empty and comment (#) lines
+                continue
+
+            chrom = row[:tab]
+
+            if runs and runs[-1][0] == chrom:
+                runs[-1][1] += 1
+            else:
+                runs.append([chrom, 1])
+
+    return block[:eol], runs, block[last + 1:]
+
+class TabixIndexBuilder():
+    # builds a tabix (.tbi) binning and linear index from the rows of a
+    # VCF in file order, fed one block at a time
+    def __init__(self):
+        self.names   = []
+        self.refs    = []
+        self._carry  = None # start of a row continued in the next block
+        self._start  = None
+
+    def addBlock(self, real_pos, block_len, block_size, block_rows):
+        head, rows, tail = block_rows
+
+        if head is None:
+            if self._carry is None:
+                self._carry = b""
+                self._start = real_pos << 16
+            self._carry += tail
+            return
+
+        head_end = self._voffset(real_pos, block_len, block_size, len(head))
+
+        if self._carry is not None:
+            self._addLine(self._carry + head, self._start, head_end)
+        else:
+            self._addLine(head, real_pos << 16, head_end)
+
+        for start, end, chrom, beg, row_end in rows:
+            self.add(chrom, beg, row_end, (real_pos << 16) | start, self._voffset(real_pos, block_len, block_size, end))
+
+        if len(tail) > 0:
+            self._carry = tail
+            self._start = (real_pos << 16) | (block_size - len(tail))
+        else:
+            self._carry = None
+            self._start = None
+
+    def _voffset(self, real_pos, block_len, block_size, offset):
+        # as htslib: the end of a block is the start of the next one
+        if offset >= block_size:
+            return (real_pos + block_len) << 16
+        return (real_pos << 16) | offset
+
+    def _addLine(self, line, vbeg, vend):
+        line = line.rstrip(b"\n")
+        if len(line) == 0 or line[0] == 35:
+            return
+        chrom, beg, end = parseTabixRow(line)
+        self.add(chrom, beg, end, vbeg, vend)
+
+    def add(self, chrom, beg, end, vbeg, vend):
+        if not self.names or self.names[-1] != chrom:
+            if chrom in self.names:
+                raise ValueError(f"chromosome {chrom} is not contiguous. the file is not sorted")
+            self.names.append(chrom)
+            self.refs .append({"bins": {}, "ioffs": [], "last_bin": None, "last_beg": -1})
+
+        ref = self.refs[-1]
+
+        if beg < ref["last_beg"]:
+            raise ValueError(f"{chrom}:{beg + 1} after {chrom}:{ref['last_beg'] + 1}. the file is not sorted")
+
+        ref["last_beg"] = beg
+
+        bin_n  = reg2bin(beg, max(end, beg + 1))
+        chunks = ref["bins"].setdefault(bin_n, [])
+
+        if ref["last_bin"] == bin_n and chunks and chunks[-1][1] == vbeg:
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vbeg, vend])
+
+        ref["last_bin"] = bin_n
+
+        ioffs = ref["ioffs"]
+        for win_n in range(beg >> 14, ((max(end, beg + 1) - 1) >> 14) + 1):
+            if win_n >= len(ioffs):
+                ioffs.extend([None] * (win_n + 1 - len(ioffs)))
+            if ioffs[win_n] is None:
+                ioffs[win_n] = vbeg
+
+    def toBytes(self):
+        names_s = b"".join(name.encode() + b"\x00" for name in self.names)
+        res     = [TABIX_MAGIC, struct.pack("<8i", len(self.names), 2, 1, 2, 0, ord("#"), 0, len(names_s)), names_s]
+
+        for ref in self.refs:
+            res.append(struct.pack("<i", len(ref["bins"])))
+
+            for bin_n in sorted(ref["bins"]):
+                chunks = ref["bins"][bin_n]
+                res.append(struct.pack(f"<Ii{2*len(chunks)}Q", bin_n, len(chunks), *(v for chunk in chunks for v in chunk)))
+
+            # empty windows point at the previous row (or the first one)
+            ioffs = ref["ioffs"]
+            last  = next(v for v in ioffs if v is not None)
+            for win_n, ioff in enumerate(ioffs):
+                if ioff is None:
+                    ioffs[win_n] = last
+                last = ioffs[win_n]
+
+            res.append(struct.pack(f"<i{len(ioffs)}Q", len(ioffs), *ioffs))
+
+        return b"".join(res)
+
+def saveTabix(ingz, builder):
+    outfile = ingz + TABIX_EXTENSION
+
+    logger.info(f"saving  {outfile}")
+
+    with open(outfile, "wb") as fhd:
+        fhd.write(bgzfCompress(builder.toBytes()))
+
+def readTabix(infile, lazy=False):
     logger.info(f"reading {infile}{TABIX_EXTENSION}")
 
     (ingz, inid, inbj, inbk) = getFilenames(infile)
@@ -272,9 +686,13 @@ def readTabix(infile):
 
     fhd        = gzip.open(inid, "rb")
 
+    # lazy: only the index is read. block information is looked up on demand
     inf = None
-    if os.path.exists(ingz):
+    if os.path.exists(ingz) and not lazy:
         inf        = open(ingz, "rb")
+
+    # shared by all references: chunks of neighbouring references share blocks
+    cache      = BlockPosCache()
     
     get_values = genStructValueGetter(fhd)
     data       = {}
@@ -384,6 +802,13 @@ def readTabix(infile):
             assert n_chunk >     0, n_chunk
             assert n_chunk < 2**31, n_chunk
 
+            if bin_v == TABIX_PSEUDO_BIN:
+                # htslib metadata: virtual offsets of the first and last row
+                # of the reference and its mapped and unmapped row counts
+                (off_beg, off_end, n_mapped, n_unmapped) = get_values('<' + ('Q'*(n_chunk*2)))[:4]
+                ref["pseudo_bin"] = {"off_beg": off_beg, "off_end": off_end, "n_mapped": n_mapped, "n_unmapped": n_unmapped}
+                continue
+
             ref["bins"][bin_n] = {
                 "bin_n"  : bin_n,
                 "bin"    : bin_v,
@@ -458,7 +883,7 @@ def readTabix(infile):
 
                 chunk_nfo_beg = position_memoize.get(chk_beg, None)
                 if chunk_nfo_beg is None:
-                    chunk_nfo_beg = getPosData(bin_n, chunk_n, inf, chk_real_beg, chk_bytes_beg, ref['ref_name'])
+                    chunk_nfo_beg = getPosData(bin_n, chunk_n, inf, chk_real_beg, chk_bytes_beg, ref['ref_name'], cache=cache)
                     position_memoize[chk_beg] = chunk_nfo_beg
 
                 chk_bin_pos_beg, chk_first_pos_beg, chk_last_pos_beg, chk_block_len_beg = [chunk_nfo_beg.get(k, None) for  k in ["bin_pos", "first_pos", "last_pos", "block_len"]]
@@ -466,7 +891,7 @@ def readTabix(infile):
 
                 chunk_nfo_end = position_memoize.get(chk_end, None)
                 if chunk_nfo_end is None:
-                    chunk_nfo_end = getPosData(bin_n, chunk_n, inf, chk_real_end, chk_bytes_end, ref['ref_name'])
+                    chunk_nfo_end = getPosData(bin_n, chunk_n, inf, chk_real_end, chk_bytes_end, ref['ref_name'], cache=cache)
                     position_memoize[chk_end] = chunk_nfo_end
 
                 chk_bin_pos_end, chk_first_pos_end, chk_last_pos_end, chk_block_len_end = [chunk_nfo_end.get(k, None) for  k in ["bin_pos", "first_pos", "last_pos", "block_len"]]
@@ -511,6 +936,10 @@ def readTabix(infile):
             ref["bins"      ][bin_n]["chunks_begin"] = chunks_data["chunk_begin"][ 0]
             ref["bins"      ][bin_n]["chunks_end"  ] = chunks_data["chunk_end"  ][-1]
 
+        if ref.get("pseudo_bin", None) is not None:
+            ref["bins" ] = [bin_data for bin_data in ref["bins"] if bin_data is not None]
+            ref["n_bin"] = len(ref["bins"])
+
         # logger.debug(f'bins_begin {ref["bins_begin"]}')
         # logger.debug(f'bins_end   {ref["bins_end"  ]}')
 
@@ -521,29 +950,8 @@ def readTabix(infile):
         ref["first_block"] = ref["bins_begin"]
         ref["last_block" ] = ref["bins_end"  ]
 
-        lastReal = None
         if inf is not None:
-            lastReal     = last_bin["real"] + last_block_len
-        
-            chrom_name   = ref["ref_name"]
-            extra_blocks = []
-            e            = 0
-
-            while last_block_len > 0 and last_last_pos > 0 and chrom_name == ref["ref_name"]:
-                chrom_name = ref['ref_name']
-                # last_bin_pos, last_first_pos, last_last_pos, last_block_len, _, _, _, _ = getPos(inf, lastReal, 0, ref['ref_name'])
-                last_nfo       = getPosData(-1, -1, inf, lastReal, 0, ref['ref_name'])
-
-                last_bin_pos, last_first_pos, last_last_pos, last_block_len = [last_nfo[k] for  k in ["bin_pos", "first_pos", "last_pos", "block_len"]]
-
-                if last_block_len > 0 and last_last_pos > 0:# and chrom_name == ref["ref_name"]:
-                    logger.debug(f"TAIL {e} chrom_name {chrom_name} last_bin_pos {last_bin_pos:12,d} last_first_pos {last_first_pos:12,d} last_last_pos {last_last_pos:12,d} last_block_len {last_block_len:12,d}")
-                    extra_blocks.append(last_nfo)
-                lastReal += last_block_len
-                e += 1
-
-            if len(extra_blocks) > 0:
-                ref["last_block" ] = extra_blocks[-1]
+            ref["last_block" ] = getLastBlock(inf, ref["ref_name"], last_bin, cache=cache)
 
         (n_intv,)  = get_values('<i')
         logger.debug(f"     n_intv              # 16kb intervals (for the linear index)         int32_t  {n_intv:15,d}")
@@ -573,7 +981,7 @@ def readTabix(infile):
             
             ioff_nfo = position_memoize.get(ioff, None)
             if ioff_nfo is None:
-                ioff_nfo = getPosData(-1 ,-1, inf, ioff_real, ioff_bytes, ref['ref_name'])
+                ioff_nfo = getPosData(-1 ,-1, inf, ioff_real, ioff_bytes, ref['ref_name'], cache=cache)
 
             ioff_bin_pos, ioff_first_pos, ioff_last_pos, ioff_block_len = [ioff_nfo.get(k, None) for  k in ["bin_pos", "first_pos", "last_pos", "block_len"]]
             
@@ -604,10 +1012,20 @@ def readTabix(infile):
         logger.debug(f" n_no_coor (optional)    # unmapped reads without coordinates set        uint64_t {n_no_coor:15,d}")
 
     data["n_no_coor"] = n_no_coor
+    # a .tbi older than the data file may not describe it: it is marked as
+    # stale, so nothing derived from it passes for fresh
+    if   not os.path.exists(ingz):
+        data["source"   ] = None
+    elif isIndexOlder(inid, ingz):
+        logger.warning(f"TBI index {inid} is older than {ingz}. marking it as stale")
+        data["source"   ] = {"stale": True}
+    else:
+        data["source"   ] = sourceFingerprint(ingz)
 
     fhd.close()
     if inf:
         inf.close()
+        logger.info(f"block lookups {cache.requests:12,d} decompressions {cache.decompressions:12,d} saved {cache.saved:12,d}")
 
     logger.debug("finished reading")
 
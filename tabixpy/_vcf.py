@@ -0,0 +1,176 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class VcfRecord():
+    # a VCF row wrapping its raw bytes. CHROM, POS, ID, REF and ALT are parsed
+    # on creation; QUAL, FILTER, INFO, FORMAT and the samples are only parsed
+    # when first accessed, decoding only the column they need. INFO, FORMAT
+    # and the samples are cached.
+    __slots__ = ["_raw", "_restOff", "_info", "_format", "_samples", "chrom", "pos", "id", "ref", "alt"]
+
+    def __init__(self, raw):
+        cols = raw.split(b"\t", 5)
+
+        if len(cols) < 5:
+            raise ValueError(f"invalid VCF row: {raw[:100]!r}")
+
+        self._raw     = raw
+        self._restOff = len(raw) - len(cols[5]) if len(cols) > 5 else len(raw)
+        self._info    = None
+        self._format  = None
+        self._samples = None
+
+        self.chrom    = cols[0].decode()
+        self.pos      = int(cols[1])
+        self.id       = cols[2].decode()
+        self.ref      = cols[3].decode()
+        self.alt      = cols[4].decode().split(",")
+
+    def _field(self, field_n):
+        # column field_n after ALT (0 QUAL, 1 FILTER, 2 INFO, 3 FORMAT).
+        # None if the row is shorter
+        raw = self._raw
+        beg = self._restOff
+
+        if beg >= len(raw):
+            return None
+
+        for _ in range(field_n):
+            beg = raw.find(b"\t", beg) + 1
+            if beg == 0:
+                return None
+
+        end = raw.find(b"\t", beg)
+
+        return raw[beg:end if end != -1 else len(raw)].decode()
+
+    @property
+    def raw(self):
+        return self._raw
+
+    @property
+    def line(self):
+        return self._raw.decode()
+
+    @property
+    def qual(self):
+        qual = self._field(0)
+        return None if qual is None or qual == "." else float(qual)
+
+    @property
+    def filter(self):
+        filters = self._field(1)
+        return [] if filters is None or filters == "." else filters.split(";")
+
+    @property
+    def info(self):
+        # flags are True, everything else stays a string
+        if self._info is None:
+            info = {}
+            text = self._field(2)
+
+            if text is not None and text != ".":
+                for field in text.split(";"):
+                    key, sep, val = field.partition("=")
+                    info[key] = val if sep else True
+
+            self._info = info
+
+        return self._info
+
+    @property
+    def format(self):
+        if self._format is None:
+            keys         = self._field(3)
+            self._format = [] if keys is None else keys.split(":")
+
+        return self._format
+
+    @property
+    def samples(self):
+        # one dict of FORMAT key to value per sample. trailing dropped
+        # fields are missing from the dict
+        if self._samples is None:
+            keys = self.format
+            cols = self._raw[self._restOff:].decode().split("\t")[4:] if keys else []
+
+            self._samples = [dict(zip(keys, sample.split(":"))) for sample in cols]
+
+        return self._samples
+
+    def sample(self, sample_n):
+        return self.samples[sample_n]
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __repr__(self):
+        return f"VcfRecord({self.chrom}:{self.pos} {self.ref}>{','.join(self.alt)})"
+
+
+def parseGenotype(gt, ploidy):
+    # slow path for a single GT field: multi digit alleles, other ploidies.
+    # missing alleles and missing trailing alleles are -1
+    alleles = gt.replace("|", "/").split("/")[:ploidy]
+    vals    = [-1 if a in (".", "") else int(a) for a in alleles]
+
+    if any(v > 127 for v in vals):
+        raise ValueError(f"allele index does not fit int8: {gt}")
+
+    return vals + [-1] * (ploidy - len(vals))
+
+def decodeGenotypes(records, numSamples, sampleIndexes, ploidy):
+    # int8 (records x samples x ploidy) matrix of the GT fields of a batch of
+    # records. all sample fields of the batch are joined into one buffer and
+    # the common single digit GTs ("0/1", "1|1", "./.") are decoded with numpy
+    # at once. only the fields which do not fit that layout are parsed one
+    # by one.
+    numRows = len(records)
+    gts     = np.full((numRows, len(sampleIndexes), ploidy), -1, dtype=np.int8)
+    texts   = []
+    rows    = []
+
+    for row_n, rec in enumerate(records):
+        cols = rec._raw[rec._restOff:].split(b"\t", 4)
+
+        if len(cols) < 5 or not (cols[3] == b"GT" or cols[3].startswith(b"GT:")):
+            continue # no genotypes. all missing
+
+        texts.append(cols[4])
+        rows.append(row_n)
+
+    if not texts:
+        return gts
+
+    width  = 2 * ploidy
+    joined = b"\t".join(texts) + b"\t" * width
+    buf    = np.frombuffer(joined, dtype=np.uint8)
+    starts = np.concatenate(([0], np.flatnonzero(buf[:-width] == 9) + 1))
+
+    if len(starts) != len(texts) * numSamples:
+        raise ValueError(f"expected {numSamples} samples per row. got {len(starts) / len(texts):.2f} on average")
+
+    starts  = starts.reshape(len(texts), numSamples)[:, sampleIndexes]
+
+    chars   = np.stack([buf[starts + 2 * k] for k in range(ploidy)], axis=-1)
+    valid   = ((chars >= 48) & (chars <= 57)) | (chars == 46)          # 0-9 .
+    valid   = valid.all(axis=-1)
+    for k in range(ploidy - 1):
+        sep    = buf[starts + 2 * k + 1]
+        valid &= (sep == 47) | (sep == 124)                            # / |
+    term    = buf[starts + width - 1]
+    valid  &= (term == 58) | (term == 9)                               # : tab
+
+    vals    = np.where(chars == 46, -1, chars.astype(np.int16) - 48).astype(np.int8)
+    vals[~valid] = -1
+
+    gts[rows] = vals
+
+    for text_n, sample_n in zip(*np.nonzero(~valid)):
+        beg  = int(starts[text_n, sample_n])
+        gt   = joined[beg:joined.find(b"\t", beg)].split(b":", 1)[0].decode()
+        gts[rows[text_n], sample_n] = parseGenotype(gt, ploidy)
+
+    return gts
@@ -1,7 +1,13 @@
+import os
 import sys
+import itertools
+import collections
+
+from concurrent.futures import ProcessPoolExecutor
 
 from ._io     import getFilenames, saveVcfGzPy, loadVcfGzPy
-from ._tabix  import getPos
+from ._gzip   import scanBlocks, sourceFingerprint, getBlock, EOF, BGZIP_EOF
+from ._tabix  import parseBlock, blockRows, blockRowStarts, TabixIndexBuilder, saveTabix
 from ._logger import logger, getLogLevel
 
 """
@@ -17,9 +23,103 @@ import tabixpy; _= tabixpy.genVcfGzPy("tests/annotated_tomato_150.vcf.bgz")
 import tabixpy; _= tabixpy.loadVcfGzPy("tests/annotated_tomato_150.vcf.bgz")
 """
 
-def _parseBGZ(filehandle):
+def _readBlock(filehandle, lastReal, withRows):
+    # getPos of a block plus the rows starting in it (blockRowStarts) and, if
+    # withRows, the rows for the tabix index (blockRows), all taken from the
+    # same decompressed block
+    block, block_len = getBlock(filehandle, lastReal)
+
+    if isinstance(block, EOF):
+        return -1, -1, -1, block_len, -1, None, -1, -1, None, None
+
+    bin_pos, first_pos, last_pos, chrom_name, num_cols, num_rows = parseBlock(block, 0, None)
+
+    block_rows = blockRows(block.encode()) if withRows else None
+
+    return bin_pos, first_pos, last_pos, block_len, len(block), chrom_name, num_cols, num_rows, blockRowStarts(block), block_rows
+
+def _iterBGZ(filehandle, lastReal=0, withRows=False):
     block_len      = 0
-    lastReal       = 0
+    file_size      = os.fstat(filehandle.fileno()).st_size
+
+    while block_len >= 0:
+        _, first_pos, last_pos, block_len, block_size, chrom_name, num_cols, num_rows, row_starts, block_rows = _readBlock(filehandle, lastReal, withRows)
+
+        if block_len < 0 and lastReal + len(BGZIP_EOF) < file_size:
+            # EOF marker of a BGZF file which had more BGZF data appended
+            lastReal += len(BGZIP_EOF)
+            block_len = 0
+            continue
+
+        yield lastReal, first_pos, last_pos, block_len, block_size, chrom_name, num_cols, num_rows, row_starts, block_rows
+
+        lastReal += block_len
+
+def _parseBGZRange(infile, reals, withRows=False):
+    res = []
+
+    with open(infile, "rb") as filehandle:
+        for lastReal in reals:
+            _, first_pos, last_pos, block_len, block_size, chrom_name, num_cols, num_rows, row_starts, block_rows = _readBlock(filehandle, lastReal, withRows)
+
+            if block_len < 0: # EOF marker. more may have been appended after it
+                continue
+
+            res.append((lastReal, first_pos, last_pos, block_len, block_size, chrom_name, num_cols, num_rows, row_starts, block_rows))
+
+    return res
+
+RANGE_BLOCKS = 256 # most blocks parsed by a worker at once
+RANGE_WINDOW = 2   # ranges in flight per worker
+
+def _iterBGZParallel(infile, workers, withRows=False):
+    reals      = scanBlocks(infile).reals
+
+    # several ranges per worker so that a slow range does not stall the pool,
+    # of at most RANGE_BLOCKS blocks. only workers * RANGE_WINDOW ranges are
+    # submitted at once, so the parent does not hold the rows (withRows) of
+    # the whole file when it consumes them slower than the pool parses them
+    num_ranges = min(len(reals), workers * 4) or 1
+    range_size = max(1, min(-(-len(reals) // num_ranges), RANGE_BLOCKS))
+    ranges     = [reals[r:r+range_size] for r in range(0, len(reals), range_size)]
+
+    logger.info(f"getAllPositions :: {len(reals):12,d} blocks in {len(ranges):6,d} ranges using {workers:3,d} workers")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        ranges  = iter(ranges)
+        pending = collections.deque()
+
+        def submit(num):
+            for blocks in itertools.islice(ranges, num):
+                pending.append(executor.submit(_parseBGZRange, infile, blocks, withRows))
+
+        try:
+            submit(workers * RANGE_WINDOW)
+
+            while pending:
+                res = pending.popleft().result()
+                submit(1)
+
+                for block_nfo in res:
+                    yield block_nfo
+
+        finally:
+            for future in pending:
+                future.cancel()
+
+def _parseBGZ(blocks, tbi=None, startReal=0, countFrom=0, carry=None):
+    # tbi: TabixIndexBuilder fed with the rows of every block
+    #
+    # numberRows is the number of rows of the chromosome of a block which
+    # start in it, or in the blocks after it which are not indexed (too few
+    # rows). rows which start there but belong to another chromosome (where
+    # one chromosome ends and the next begins) are counted in strayRows, as
+    # {chrom: [[real, count], ...]} with the real position of the block.
+    # rows split between blocks are counted where they start.
+    #
+    # startReal: real position given to rows before the first indexed block.
+    # countFrom: rows starting before this real position are not counted.
+    # carry: (real, text) of a row started before the first block
     chroms         = []
     lastChrom      = None
     numCols        = None
@@ -27,15 +127,46 @@ def _parseBGZ(filehandle):
     firsts         = []
     lasts          = []
     rows           = []
+    strays         = {}
     e              = 0
     ce             = 0
 
-    while block_len >= 0:
-        _, first_pos, last_pos, block_len, block_size, chrom_name, num_cols, num_rows = getPos(filehandle, lastReal, 0, None)
+    entry          = None # (chrom_n, block_n) of the last indexed block
+    pending        = None # real position and entry of the row in progress
+    prefix         = ""   # start of the row in progress, up to the first tab
+
+    def countRows(chrom, row_real, row_entry, num_rows):
+        if row_real < countFrom:
+            return
+
+        if row_entry is not None and chroms[row_entry[0]] == chrom:
+            rows[row_entry[0]][row_entry[1]] += num_rows
+            return
+
+        real  = startReal if row_entry is None else reals[row_entry[0]][row_entry[1]]
+        spans = strays.setdefault(chrom, {})
+        spans[real] = spans.get(real, 0) + num_rows
+
+    def countRow(row, row_real, row_entry):
+        tab = row.find("\t")
+        if tab > 0 and row[0] != "#":
+            countRows(row[:tab], row_real, row_entry, 1)
+
+    def cut(row):
+        tab = row.find("\t")
+        return row if tab == -1 else row[:tab + 1]
 
+    if carry is not None:
+        pending = (carry[0], None)
+        prefix  = cut(carry[1])
+
+    for lastReal, first_pos, last_pos, block_len, block_size, chrom_name, num_cols, num_rows, row_starts, block_rows in blocks:
         if block_len < 0:
             logger.info(f"block_len {block_len}")
 
+        elif tbi is not None and block_rows is not None:
+            tbi.addBlock(lastReal, block_len, block_size, block_rows)
+
         e  += 1
         ce += 1
 
@@ -49,35 +180,63 @@ def _parseBGZ(filehandle):
         if numCols is None:
             numCols = num_cols
 
-        if chrom_name is None:
+        if chrom_name is not None:
+            if lastChrom != chrom_name:
+                if e > 1:
+                    logger.info(f"getAllPositions :: read    block {e-1:12,d} {ce-1:12,d} {lastChrom}")
+
+                logger.info(f'getAllPositions :: new chrom :: {chrom_name}')
+                logger.info(f"  lastReal {lastReal:12,d} first_pos {first_pos:12,d} last_pos {last_pos:12,d} block_len {block_len:7,d} block_size {block_size:7,d} num_cols {num_cols:5,d} num_rows {num_rows:5,d} chrom_name {chrom_name}")
+
+                lastChrom = chrom_name
+                ce        = 1
+                chroms    .append(chrom_name)
+                reals     .append([])
+                firsts    .append([])
+                lasts     .append([])
+                rows      .append([])
+
+            if getLogLevel() == "DEBUG":
+                logger.debug(f"getAllPositions {e:4,d} :: lastReal {lastReal:9,d} first_pos {first_pos:9,d} last_pos {last_pos:9,d} block_len {block_len:7,d} block_size {block_size:7,d} chrom_name {chrom_name} num_cols {num_cols:3,d} num_rows {num_rows:3,d}")
+
+            reals [-1].append(lastReal)
+            firsts[-1].append(first_pos)
+            lasts [-1].append(last_pos)
+            rows  [-1].append(0)
+
+            entry = (len(chroms) - 1, len(rows[-1]) - 1)
+
+        else:
             logger.debug(f"chrom_name {chrom_name} is NONE")
-            lastReal += block_len
+
+        if row_starts is None:
             continue
 
-        if lastChrom != chrom_name:
-            if e > 1:
-                logger.info(f"getAllPositions :: read    block {e-1:12,d} {ce-1:12,d} {lastChrom}")
+        head, runs, tail = row_starts
 
-            logger.info(f'getAllPositions :: new chrom :: {chrom_name}')
-            logger.info(f"  lastReal {lastReal:12,d} first_pos {first_pos:12,d} last_pos {last_pos:12,d} block_len {block_len:7,d} block_size {block_size:7,d} num_cols {num_cols:5,d} num_rows {num_rows:5,d} chrom_name {chrom_name}")
+        if head is None: # no newline. the row in progress goes on
+            if pending is None:
+                pending = (lastReal, entry)
+            prefix = cut(prefix + tail)
+            continue
 
-            lastChrom = chrom_name
-            ce        = 1
-            chroms    .append(chrom_name)
-            reals     .append([])
-            firsts    .append([])
-            lasts     .append([])
-            rows      .append([])
+        if pending is None:
+            countRow(head, lastReal, entry)
+        else:
+            countRow(prefix + head, pending[0], pending[1])
 
-        if getLogLevel() == "DEBUG":
-            logger.debug(f"getAllPositions {e:4,d} :: lastReal {lastReal:9,d} first_pos {first_pos:9,d} last_pos {last_pos:9,d} block_len {block_len:7,d} block_size {block_size:7,d} chrom_name {chrom_name} num_cols {num_cols:3,d} num_rows {num_rows:3,d}")
+        for chrom, num_rows in runs:
+            countRows(chrom, lastReal, entry, num_rows)
 
-        reals [-1].append(lastReal)
-        firsts[-1].append(first_pos)
-        lasts [-1].append(last_pos)
-        rows  [-1].append(num_rows)
+        if tail:
+            pending = (lastReal, entry)
+            prefix  = cut(tail)
+        else:
+            pending = None
+            prefix  = ""
 
-        lastReal += block_len
+    if pending is not None: # no newline at the end of the file
+        countRow(prefix, pending[0], pending[1])
 
     logger.info(f"getAllPositions :: read    block {e-1:12,d} {ce-1:12,d} {lastChrom}")
 
@@ -89,21 +248,39 @@ def _parseBGZ(filehandle):
         "firstPositions": firsts,
         "lastPositions" : lasts,
         "numberRows"    : rows,
+        "strayRows"     : {chrom: [[real, num_rows] for real, num_rows in sorted(spans.items())] for chrom, spans in strays.items()},
     }
 
     res["chromLength"] = sum(res["chromSizes"])
     
     return res
 
-def readBGZ(infile, save=False):
+def readBGZ(infile, save=False, workers=1, tbi=False):
+    # tbi: also writes a tabix index (.tbi) built in the same pass
     # setLogLevel(logging.DEBUG)
 
     logger.info(f"reading {infile}")
 
     (ingz, inid, inbj, inbk) = getFilenames(infile)
 
+    if workers is None or workers <= 0:
+        workers = os.cpu_count() or 1
+
+    source     = sourceFingerprint(ingz)
+
     inf        = open(ingz, "rb")
-    data       = _parseBGZ(inf)
+
+    builder    = TabixIndexBuilder() if tbi else None
+
+    if workers == 1:
+        data   = _parseBGZ(_iterBGZ(inf, withRows=tbi), tbi=builder)
+    else:
+        data   = _parseBGZ(_iterBGZParallel(ingz, workers, withRows=tbi), tbi=builder)
+
+    data["source"] = source
+
+    if tbi:
+        saveTabix(ingz, builder)
 
     if getLogLevel() == "DEBUG":
         chroms     = data["chroms"]
@@ -127,6 +304,89 @@ def readBGZ(infile, save=False):
 
     return data
 
+def updateBGZ(infile, data):
+    # extends the TBK data of infile with the blocks appended after the last
+    # indexed one. the last indexed block and the first block of every
+    # chromosome are parsed again and must match the index, else the file
+    # was changed rather than appended to and ValueError is raised.
+    # only the rows starting after the end of the indexed file are counted.
+    # returns the extended data, or None if there is nothing new
+    (ingz, inid, inbj, inbk) = getFilenames(infile)
+
+    lstKs = ["realPositions", "firstPositions", "lastPositions", "numberRows"]
+
+    if len(data["chroms"]) == 0:
+        return None
+
+    source = sourceFingerprint(ingz)
+    strays = data.get("strayRows", None)
+    size   = data["source"]["size"] if data.get("source", None) is not None else None
+
+    with open(ingz, "rb") as inf:
+        checks = [(chrom_n, 0) for chrom_n in range(len(data["chroms"]))] + [(len(data["chroms"]) - 1, -1)]
+
+        for chrom_n, block_n in checks:
+            lastReal = data["realPositions"][chrom_n][block_n]
+            _, first_pos, last_pos, block_len, _, chrom_name, _, _, row_starts, _ = _readBlock(inf, lastReal, False)
+
+            indexed = tuple(data[lstK][chrom_n][block_n] for lstK in lstKs[1:3])
+            if block_len < 0 or (first_pos, last_pos) != indexed or chrom_name != data["chroms"][chrom_n]:
+                raise ValueError(f"index does not match {ingz} at block {lastReal:,d}. the file was not appended to. recreate the index")
+
+        if strays is not None and size is None:
+            raise ValueError(f"index of {ingz} has no source fingerprint. recreate the index")
+
+        # the rows from the last indexed block up to the old end of the file
+        # are counted already
+        blocks = _iterBGZ(inf, lastReal=lastReal + block_len)
+        new    = _parseBGZ(blocks, startReal=lastReal, countFrom=size or 0, carry=(lastReal, row_starts[2]) if row_starts[2] else None)
+
+    if new["chromLength"] == 0 and not new["strayRows"]:
+        logger.info(f"updating {ingz} :: no new blocks")
+        return None
+
+    res = {lstK: [list(chrom_data) for chrom_data in data[lstK]] for lstK in lstKs}
+    res["chroms"   ] = list(data["chroms"])
+    res["numCols"  ] = data["numCols"]
+    res["source"   ] = source
+    res["strayRows"] = None
+
+    if strays is not None:
+        # rows before the first new block belong to the last indexed one
+        res["strayRows"] = {chrom: [list(span) for span in spans] for chrom, spans in strays.items()}
+
+        for chrom, spans in new["strayRows"].items():
+            for real, num_rows in spans:
+                if real == lastReal and chrom == res["chroms"][-1]:
+                    res["numberRows"][-1][-1] += num_rows
+                    continue
+
+                chromSpans = res["strayRows"].setdefault(chrom, [])
+                if chromSpans and chromSpans[-1][0] == real:
+                    chromSpans[-1][1] += num_rows
+                else:
+                    chromSpans.append([real, num_rows])
+
+    for chrom_n, chrom in enumerate(new["chroms"]):
+        if chrom_n == 0 and chrom == res["chroms"][-1]:
+            for lstK in lstKs:
+                res[lstK][-1].extend(new[lstK][chrom_n])
+            continue
+
+        if chrom in res["chroms"]:
+            raise ValueError(f"chromosome {chrom} appended to {ingz} is already indexed. the file is not sorted")
+
+        res["chroms"].append(chrom)
+        for lstK in lstKs:
+            res[lstK].append(new[lstK][chrom_n])
+
+    res["chromSizes" ] = [len(d) for d in res["numberRows"]]
+    res["chromLength"] = sum(res["chromSizes"])
+
+    logger.info(f"updating {ingz} :: {new['chromLength']:,d} new blocks")
+
+    return res
+
 def main(infile):
     genVcfGzPy(infile)
     loadVcfGzPy(infile)
@@ -1,15 +1,29 @@
 import os
 import sys
+import gzip
 import json
+import random
+import itertools
 import bisect
+import asyncio
+import threading
 
-from ._gzip       import openGzipStream
-from ._io         import getFilenames
+from collections        import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from ._gzip       import openGzipStream, isSourceFresh, isIndexOlder
+from ._gzip       import scanBlocks, BlockTable
+from ._gzip       import BlockCache, FileHandlePool
+from ._gzip       import setBlockDecoder, getBlockDecoder, INFLATERS
+from ._io         import getFilenames, readBed
 from ._io         import loadTabixPy, saveTabixPy
 from ._io         import loadVcfGzPy, saveVcfGzPy
 from ._logger     import logger, setLogLevel, getLogLevel
-from ._tabix      import readTabix
-from ._vcfbgzpy   import readBGZ
+from ._tabix      import readTabix, reg2bin, reg2bins, getChunks, buildRefIndexes
+from ._tabix      import getPosDataLazy, getLastBlock
+from ._consts     import TABIX_BLOCK_BYTES_MASK, BLOCK_CACHE_SIZE
+from ._vcfbgzpy   import readBGZ, updateBGZ
+from ._vcf        import VcfRecord, decodeGenotypes, np
 
 from enum import Enum, auto
 class Formats(Enum):
@@ -21,25 +35,64 @@ class TabixDefaults():
     OVERWRITE = True
     COMPRESS  = True
     CINE      = True
+    WORKERS   = 1
+    CACHESIZE = BLOCK_CACHE_SIZE
+    LAZY      = False
+    HANDLES   = 8
+    AWORKERS  = 4
+    ABATCH    = 1000
+    READAHEAD = 0
+    GTBATCH   = 4096
+    VERIFY    = False
+    PWINDOW   = 4
 
 class Tabix(TabixDefaults):
-    def __init__(self, ingz, indexType=Formats.DEFAULT, logLevel=None):
+    def __init__(self, ingz, indexType=Formats.DEFAULT, logLevel=None, cacheSize=TabixDefaults.CACHESIZE, cache=None, lazy=TabixDefaults.LAZY, maxHandles=TabixDefaults.HANDLES, asyncWorkers=TabixDefaults.AWORKERS, readAhead=TabixDefaults.READAHEAD):
         self._infile    = ingz
         self._indexType = indexType
+        self._lazy      = lazy
+        self._blockData = {}
         self._numCols   = None
         self._data      = None
         self._type      = None
+        self._blocks    = None
+        self._refs      = None
+        self._cache     = cache
+        self._lock      = threading.Lock()
+        self._aworkers  = asyncWorkers
+        self._aexecutor = None
+        self._alimit    = None
+        self._readAhead = readAhead
+        self._waits     = {"consumer": 0, "producer": 0}
+        self._header    = None
+
+        if self._cache is None and cacheSize is not None and cacheSize > 0:
+            self._cache = BlockCache(cacheSize)
 
         if logLevel is not None:
             setLogLevel(logLevel)
 
         self._inbgz, self._intbi, self._intbj, self._intbk = getFilenames(self._infile)
 
-    def create(self, overwrite=TabixDefaults.OVERWRITE, compress=TabixDefaults.COMPRESS):
+        self._pool      = FileHandlePool(self._inbgz, maxHandles)
+
+    def close(self):
+        if self._aexecutor is not None:
+            self._aexecutor.shutdown(wait=True)
+            self._aexecutor = None
+        self._pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def create(self, overwrite=TabixDefaults.OVERWRITE, compress=TabixDefaults.COMPRESS, workers=TabixDefaults.WORKERS, tbi=False):
         if   self._indexType == Formats.TBJ:
             self.createTBJ(overwrite=overwrite, compress=compress)
         elif self._indexType == Formats.TBK:
-            self.createTBK(overwrite=overwrite, compress=compress)
+            self.createTBK(overwrite=overwrite, compress=compress, workers=workers, tbi=tbi)
         else:
             raise ValueError(f"NO SUCH INDEX TYPE {self._indexType}. Valid values are TBJ and TBK")
 
@@ -49,12 +102,36 @@ class Tabix(TabixDefaults):
             self.loadTBI()
         self.saveTBJ(overwrite=overwrite, compress=compress)
 
-    def createTBK(self, overwrite=TabixDefaults.OVERWRITE, compress=TabixDefaults.COMPRESS):
+    def createTBK(self, overwrite=TabixDefaults.OVERWRITE, compress=TabixDefaults.COMPRESS, workers=TabixDefaults.WORKERS, tbi=False):
+        # tbi: also write the tabix index (.tbi) from the same scan
         logger.info(f"creating TBK")
-        if self._data is None or self._type != Formats.TBK:
-            self.loadBGZ()
+        if self._data is None or self._type != Formats.TBK or tbi:
+            self.loadBGZ(workers=workers, tbi=tbi)
         self.saveTBK(overwrite=overwrite, compress=compress)
 
+    def updateTBK(self, compress=None):
+        # indexes only the blocks appended to the BGZ file since the TBK was
+        # created and rewrites it. compress None keeps the layout of the
+        # existing TBK. returns whether there was anything new
+        logger.info(f"updating TBK")
+
+        if self._data is None or self._type != Formats.TBK:
+            self.loadTBK(create_if_not_exists=False)
+
+        if compress is None:
+            compress = self._tbkCompressed
+
+        data = updateBGZ(self._inbgz, self._data)
+
+        if data is None:
+            return False
+
+        self._data      = data
+        self._blockData = {}
+        self.saveTBK(overwrite=True, compress=compress)
+
+        return True
+
     def save(self, overwrite=TabixDefaults.OVERWRITE, compress=TabixDefaults.COMPRESS):
         if   self._type == Formats.TBJ:
             self.saveTBJ(overwrite=overwrite, compress=compress)
@@ -87,16 +164,28 @@ class Tabix(TabixDefaults):
             if not overwrite:
                 return
 
-        saveVcfGzPy(self._inbgz, self._data)
+        saveVcfGzPy(self._inbgz, self._data, compress=compress)
 
-    def load(self, create_if_not_exists=TabixDefaults.CINE):
+    def load(self, create_if_not_exists=TabixDefaults.CINE, workers=TabixDefaults.WORKERS, verify=TabixDefaults.VERIFY):
+        # an index whose source fingerprint does not match the data file any
+        # more is rebuilt if create_if_not_exists, else IOError is raised
         if self._indexType == Formats.TBK:
             if   os.path.exists(self._intbk) or create_if_not_exists:
                 logger.info(f"reading TBK index {self._intbk}")
-                self.loadTBK(create_if_not_exists=create_if_not_exists)
+                self.loadTBK(create_if_not_exists=create_if_not_exists, workers=workers, verify=verify)
             else:
                 raise IOError(f"no such index {self._intbk} OR FILE {self._inbgz}")
 
+            if not self.isFresh():
+                if not create_if_not_exists:
+                    raise IOError(f"TBK index {self._intbk} is older than {self._inbgz}")
+
+                logger.warning(f"TBK index {self._intbk} is older than {self._inbgz}. recreating")
+                compress = self._tbkCompressed
+                self.loadBGZ(workers=workers)
+                self.saveTBK(overwrite=True, compress=compress)
+                self._blockData = {}
+
         elif self._indexType == Formats.TBJ:
             if   os.path.exists(self._intbj) or create_if_not_exists:
                 logger.info(f"reading TBJ index {self._intbj}")
@@ -104,26 +193,75 @@ class Tabix(TabixDefaults):
             else:
                 raise IOError(f"no such TBJ index {self._intbj} or TBI index {self._intbi}")
 
+            if not self.isFresh():
+                if not create_if_not_exists:
+                    raise IOError(f"TBJ index {self._intbj} is older than {self._inbgz}")
+
+                if os.path.exists(self._intbi) and isIndexOlder(self._intbi, self._inbgz):
+                    # recreating from it would give the same stale index
+                    logger.warning(f"TBJ index {self._intbj} and TBI index {self._intbi} are older than {self._inbgz}. using them anyway. recreate the TBI index with createTBI(overwrite=True) if {self._inbgz} changed")
+                    return
+
+                logger.warning(f"TBJ index {self._intbj} is older than {self._inbgz}. recreating from {self._intbi}")
+                self.loadTBI(create_if_not_exists=create_if_not_exists)
+                self.saveTBJ(overwrite=True)
+
         else:
             raise ValueError(f"NO SUCH INDEX TYPE {self._type}. Valid values are DEFAULT (TBK), TBJ and TBK")
 
-    def loadBGZ(self, create_if_not_exists=TabixDefaults.CINE):
+    def isFresh(self):
+        # whether the loaded index was built from the current data file.
+        # indexes without a source fingerprint are taken as fresh
+        return isSourceFresh(self._data.get("source", None), self._inbgz)
+
+    @property
+    def _tbkCompressed(self):
+        # memory mapped (uncompressed) TBK columns are not lists
+        return isinstance(self._data["realPositions"], list)
+
+    def loadBGZ(self, create_if_not_exists=TabixDefaults.CINE, workers=TabixDefaults.WORKERS, tbi=False):
+        # tbi: also writes the tabix index (.tbi) from the same scan
         if not os.path.exists(self._inbgz):
             raise IOError(f"BGZ file {self._inbgz} does not exists")
 
         logger.info(f"loading BGZ")
 
-        self._data = readBGZ(self._inbgz)
+        self._data = readBGZ(self._inbgz, workers=workers, tbi=tbi)
         self._type = Formats.TBK
 
+    def createTBI(self, overwrite=TabixDefaults.OVERWRITE, workers=TabixDefaults.WORKERS):
+        # writes the tabix index without htslib. the TBK data of the same
+        # scan is kept, so saveTBK can follow without reading the file again
+        logger.info(f"creating TBI")
+
+        if os.path.exists(self._intbi) and not overwrite:
+            return
+
+        self.loadBGZ(workers=workers, tbi=True)
+
     def loadTBI(self, create_if_not_exists=TabixDefaults.CINE):
+        # a .tbi older than the data file may have been written by another
+        # tool and is never replaced: it is read with a warning (and marked
+        # as stale) if create_if_not_exists, else IOError is raised.
+        # createTBI(overwrite=True) rewrites it
         if not os.path.exists(self._intbi):
-            raise IOError(f"TBI file {self._intbi} does not exists")
+            if not create_if_not_exists:
+                raise IOError(f"TBI file {self._intbi} does not exists")
+            else:
+                readBGZ(self._inbgz, tbi=True)
+
+        elif isIndexOlder(self._intbi, self._inbgz):
+            if not create_if_not_exists:
+                raise IOError(f"TBI file {self._intbi} is older than {self._inbgz}. recreate it with createTBI(overwrite=True)")
+            else:
+                logger.warning(f"TBI file {self._intbi} is older than {self._inbgz}. using it anyway. recreate it with createTBI(overwrite=True) if {self._inbgz} changed")
 
         logger.info(f"loading TBI")
 
-        self._data  = readTabix(self._inbgz)
+        self._data  = readTabix(self._inbgz, lazy=self._lazy)
         self._type = Formats.TBJ
+        self._refs = buildRefIndexes(self._data)
+        self._blockData = {}
 
     def loadTBJ(self, create_if_not_exists=TabixDefaults.CINE):
         if not os.path.exists(self._intbj):
@@ -137,24 +275,32 @@ class Tabix(TabixDefaults):
 
         self._data = loadTabixPy(self._inbgz)
         self._type = Formats.TBJ
+        self._refs = buildRefIndexes(self._data)
+        self._blockData = {}
 
-    def loadTBK(self, create_if_not_exists=TabixDefaults.CINE):
+    def loadTBK(self, create_if_not_exists=TabixDefaults.CINE, workers=TabixDefaults.WORKERS, verify=TabixDefaults.VERIFY):
         if not os.path.exists(self._intbk):
             if not create_if_not_exists:
                 raise IOError(f"TBK file {self._intbk} does not exists")
             else:
-                self.loadBGZ()
+                self.loadBGZ(workers=workers)
                 self.saveTBK()
 
         logger.info(f"loading TBK")
 
-        self._data = loadVcfGzPy(self._inbgz)
+        self._data = loadVcfGzPy(self._inbgz, verify=verify)
         self._type = Formats.TBK
     
     @property
     def bgz(self):
         return self._inbgz
 
+    @property
+    def blocks(self):
+        if self._blocks is None:
+            self._blocks = scanBlocks(self._inbgz)
+        return self._blocks
+
     @property
     def indexFile(self):
         if self._indexType == Formats.TBJ:
@@ -171,6 +317,10 @@ class Tabix(TabixDefaults):
         if self._indexType == Formats.TBK:
             return self._inbgz
 
+    @property
+    def cache(self):
+        return self._cache
+
     @property
     def data(self):
         return self._data
@@ -187,73 +337,519 @@ class Tabix(TabixDefaults):
     def numCols(self):
         return self._data.get("numCols", None)
 
-    def getChromosomeIter(self, chrom, begin=None, end=None, asLine=False):
+    def getChromosomeIter(self, chrom, begin=None, end=None, asLine=False, columns=None, asRecord=False):
         assert  chrom in self.chromosomes
         assert  begin is None or begin >= 0
         assert  end   is None or end   >= 0
         assert (begin is None or end is None) or begin <= end
 
+        if asRecord and columns is not None:
+            raise ValueError("columns can not be combined with asRecord. VcfRecord parses the columns on access")
+
+        if self._indexType == Formats.TBJ:
+            return self.getChromosomeIterTBJ(chrom, begin=begin, end=end, asLine=asLine, columns=self.getColumnIndexes(columns), asRecord=asRecord)
+
+        if self._indexType == Formats.TBK:
+            return self.getChromosomeIterTBK(chrom, begin=begin, end=end, asLine=asLine, columns=self.getColumnIndexes(columns), asRecord=asRecord)
+
+    @property
+    def columnNames(self):
+        # names of the columns from the last header line (#CHROM POS ID ...)
+        if self._header is None:
+            header = None
+            with gzip.open(self._inbgz, "rt") as fhd:
+                for line in fhd:
+                    if not line.startswith("#"):
+                        break
+                    header = line
+
+            if header is None:
+                raise ValueError(f"no header line in {self._inbgz}")
+
+            self._header = header.lstrip("#").rstrip("\n").split("\t")
+
+        return self._header
+
+    def getColumnIndexes(self, columns):
+        # column names or indexes to indexes
+        if columns is None:
+            return None
+
+        names   = None
+        indexes = []
+        for col in columns:
+            if isinstance(col, str):
+                if names is None:
+                    names = self.columnNames
+                if col not in names:
+                    raise ValueError(f"no such column {col}. valid columns: {', '.join(names)}")
+                col = names.index(col)
+
+            assert col >= 0, f"column index {col} >= 0"
+
+            indexes.append(col)
+
+        assert len(indexes) > 0, "no columns selected"
+
+        return indexes
+
+    def genotypeMatrix(self, chrom, begin=None, end=None, samples=None, ploidy=2, batchSize=TabixDefaults.GTBATCH):
+        # (positions, genotypes) of a region: an int64 array of POS and an
+        # int8 (variants x samples x ploidy) array of allele indexes, -1 for
+        # missing. samples are names or indexes, all samples by default.
+        # rows are decoded in batches of batchSize into a buffer that grows
+        # by doubling.
+        if np is None:
+            raise ImportError("genotypeMatrix needs numpy")
+
+        names      = self.columnNames[9:]
+        numSamples = len(names)
+
+        if samples is None:
+            sampleIndexes = list(range(numSamples))
+        else:
+            sampleIndexes = [names.index(s) if isinstance(s, str) else s for s in samples]
+
+        capacity   = batchSize
+        positions  = np.empty(capacity, dtype=np.int64)
+        genotypes  = np.empty((capacity, len(sampleIndexes), ploidy), dtype=np.int8)
+        numRows    = 0
+
+        rows       = self.getChromosomeIter(chrom, begin=begin, end=end, asRecord=True)
+
+        while True:
+            batch = list(itertools.islice(rows, batchSize))
+
+            if not batch:
+                break
+
+            while numRows + len(batch) > capacity:
+                capacity  *= 2
+                positions  = np.resize(positions, capacity)
+                genotypes  = np.resize(genotypes, (capacity, len(sampleIndexes), ploidy))
+
+            positions[numRows:numRows+len(batch)] = [rec.pos for rec in batch]
+            genotypes[numRows:numRows+len(batch)] = decodeGenotypes(batch, numSamples, sampleIndexes, ploidy)
+            numRows += len(batch)
+
+        return positions[:numRows].copy(), genotypes[:numRows].copy()
+
+    def count(self, chrom, begin=None, end=None):
+        # number of rows with begin <= POS < end. with a TBK index it is the
+        # number of rows before end minus the number of rows before begin,
+        # each taken from numberRows and strayRows with only the block where
+        # the position falls read. other indexes, and TBK indexes without
+        # strayRows (built by older versions), stream the rows instead.
+        if self._indexType != Formats.TBK or self._data.get("strayRows", None) is None:
+            return self._countRows(chrom, begin, end)
+
+        if begin is not None and end is not None and begin >= end:
+            return 0
+
+        num_rows = self._countBefore(chrom, end) - (0 if begin is None else self._countBefore(chrom, begin))
+
+        if getLogLevel() == "DEBUG":
+            logger.debug(f"count :: chrom {chrom} begin {begin} end {end} :: rows {num_rows:,d}")
+
+        return num_rows
+
+    def _countBefore(self, chrom, pos):
+        # number of rows of chrom with POS < pos. all rows if pos is None.
+        # the blocks before the one where pos falls are counted from the index
+        idx    = self.chromosomes.index(chrom)
+        reals  = self._data["realPositions"][idx]
+        firsts = self._data["firstPositions"][idx]
+        rows   = self._data["numberRows"][idx]
+        strays = self._data["strayRows"].get(chrom, [])
+        leads  = [(real, num_rows) for real, num_rows in strays if real < reals[0]]
+
+        if pos is None:
+            return sum(rows) + sum(num_rows for _, num_rows in strays)
+
+        block_n = bisect.bisect_left(firsts, pos)
+
+        if block_n == 0: # only rows before the first block of chrom
+            if not leads:
+                return 0
+            return sum(1 for _ in self.openStream(leads[0][0], None, chrom=chrom, end=pos, columns=[1]))
+
+        num_rows  = sum(rows[:block_n - 1]) + sum(num_rows for _, num_rows in leads)
+        num_rows += sum(1 for _ in self.openStream(reals[block_n - 1], None, chrom=chrom, end=pos, columns=[1]))
+
+        return num_rows
+
+    def _countRows(self, chrom, begin, end):
+        if begin is not None and end is not None and begin >= end:
+            return 0
+
+        return sum(1 for _ in self.getChromosomeIter(chrom, begin=begin, end=end, columns=[1]))
+
+    def _nextReal(self, real):
+        # real position of the first indexed block after real, of any
+        # chromosome. None if there is none
+        nexts = []
+        for reals in self._data["realPositions"]:
+            block_n = bisect.bisect_right(reals, real)
+            if block_n < len(reals):
+                nexts.append(reals[block_n])
+
+        return min(nexts) if nexts else None
+
+    def _spanRows(self, chrom, real, asLine=False, columns=None):
+        # rows of chrom which start in the indexed block at real or in the
+        # blocks up to the next indexed one. as counted in numberRows and
+        # strayRows
+        nextReal = self._nextReal(real)
+        endVirtual = None if nextReal is None else nextReal << 16
+
+        return self.openStream(real, None, asLine=asLine, chrom=chrom, endVirtual=endVirtual, columns=columns)
+
+    def density(self, chrom, window):
+        # approximate rows per window of window bp from the TBK index. the
+        # rows of each block are spread evenly over the span between its
+        # first and last position. the rows of chrom in blocks of other
+        # chromosomes (where chromosomes meet) are read. returns (begin, end,
+        # count) per window, with 1-based [begin, end) as getChromosomeIter
+        if self._indexType != Formats.TBK:
+            raise ValueError("density needs a TBK index")
+
+        if self._data.get("strayRows", None) is None:
+            raise ValueError(f"density needs a TBK index with strayRows. recreate {self._intbk}")
+
+        assert window > 0, f"window {window} > 0"
+
+        idx    = self.chromosomes.index(chrom)
+        firsts = self._data["firstPositions"][idx]
+        lasts  = self._data["lastPositions"][idx]
+        rows   = self._data["numberRows"][idx]
+
+        counts = [0.0] * ((lasts[-1] - 1) // window + 1)
+
+        for first_pos, last_pos, num_rows in zip(firsts, lasts, rows):
+            span = last_pos - first_pos + 1
+            for win_n in range((first_pos - 1) // window, (last_pos - 1) // window + 1):
+                win_beg  = win_n * window + 1
+                overlap  = min(last_pos + 1, win_beg + window) - max(first_pos, win_beg)
+                counts[win_n] += num_rows * overlap / span
+
+        for real, _ in self._data["strayRows"].get(chrom, []):
+            for (pos,) in self._spanRows(chrom, real, columns=[1]):
+                win_n = (int(pos) - 1) // window
+                if win_n >= len(counts):
+                    counts.extend([0.0] * (win_n + 1 - len(counts)))
+                counts[win_n] += 1
+
+        return [(win_n * window + 1, (win_n + 1) * window + 1, int(round(cnt))) for win_n, cnt in enumerate(counts)]
+
+    def sample(self, n, chrom=None, seed=None, asLine=False):
+        # n rows picked uniformly at random (with the given seed) among the
+        # rows of chrom or of all chromosomes. the number of rows taken from
+        # each block is decided on numberRows and strayRows of the TBK index
+        # (split rows and rows in a block of another chromosome included);
+        # only the blocks of the picked rows are read. returns the rows in
+        # file order.
+        if self._indexType != Formats.TBK:
+            raise ValueError("sample needs a TBK index")
+
+        if self._data.get("strayRows", None) is None:
+            raise ValueError(f"sample needs a TBK index with strayRows. recreate {self._intbk}")
+
+        rng      = random.Random(seed)
+        chroms   = self.chromosomes if chrom is None else [chrom]
+        spans    = [] # (real, chrom index, rows)
+
+        for name in chroms:
+            idx = self.chromosomes.index(name)
+            spans.extend((real, idx, num_rows) for real, num_rows in zip(self._data["realPositions"][idx], self._data["numberRows"][idx]) if num_rows > 0)
+            spans.extend((real, idx, num_rows) for real, num_rows in self._data["strayRows"].get(name, []))
+
+        spans.sort()
+
+        cumsum   = list(itertools.accumulate(num_rows for _, _, num_rows in spans))
+        total    = cumsum[-1] if cumsum else 0
+
+        picks = {}
+        for row_n in rng.sample(range(total), min(n, total)):
+            span_n = bisect.bisect_right(cumsum, row_n)
+            picks[span_n] = picks.get(span_n, 0) + 1
+
+        if getLogLevel() == "DEBUG":
+            logger.debug(f"sample :: n {n} chrom {chrom} seed {seed} :: rows {total:,d} blocks {len(picks):,d} of {len(spans):,d}")
+
+        res = []
+        for span_n in sorted(picks):
+            real, idx, _ = spans[span_n]
+            rows         = list(self._spanRows(self.chromosomes[idx], real, asLine=True))
+
+            for row_n in sorted(rng.sample(range(len(rows)), min(picks[span_n], len(rows)))):
+                res.append(rows[row_n] if asLine else rows[row_n].split("\t"))
+
+        return res
+
+    def getLastPosition(self, chrom):
         if self._indexType == Formats.TBJ:
-            return self.getChromosomeIterTBJ(chrom, begin=begin, end=end, asLine=asLine)
+            return self.getLastBlock(chrom)["last_pos"]
 
         if self._indexType == Formats.TBK:
-            return self.getChromosomeIterTBK(chrom, begin=begin, end=end, asLine=asLine)
+            return self._data["lastPositions"][self.chromosomes.index(chrom)][-1]
+
+    def _regionBlocks(self, chrom, begin, end):
+        # real offsets of the first and last block a query of the region may
+        # read, from the index alone
+        idx = self.chromosomes.index(chrom)
+
+        if self._indexType == Formats.TBJ:
+            chunks = getChunks(self._refs[idx], begin=begin, end=end)
+
+            if len(chunks) == 0:
+                return -1, -1
 
-    def getChromosomeIterTBJ(self, chrom, begin=None, end=None, asLine=False):
+            return chunks[0][0] >> 16, chunks[-1][1] >> 16
+
+        reals  = self._data["realPositions"][idx]
+        firsts = self._data["firstPositions"][idx]
+
+        lo     = 0 if begin is None else bisect.bisect_left(firsts, begin)
+        hi     = len(reals) - 1 if end is None else min(bisect.bisect_left(firsts, end), len(reals) - 1)
+
+        if lo > 0:
+            firstReal = reals[lo - 1]
+        else: # rows may start in the last block of the previous chromosome
+            firstReal = self._data["realPositions"][idx - 1][-1] if idx > 0 else 0
+
+        return firstReal, reals[hi]
+
+    def queryRegions(self, regions, asLine=False, asRecord=False):
+        # yields (region_id, record) for a batch of (chrom, begin, end) regions
+        # or a BED file. region_id is the index of the region in the input.
+        # regions are sorted and the ones which overlap, or whose index blocks
+        # overlap, are coalesced into a single read, so each block is
+        # decompressed at most once per chromosome, with or without the block
+        # cache. a block shared by two chromosomes is read for each of them
+        # unless it is still in the block cache.
+        # records are yielded in genomic order, once per region containing them.
+        if isinstance(regions, str):
+            regions = readBed(regions)
+
+        chroms   = self.chromosomes
+        inf      = float("inf")
+        byChrom  = {}
+        for region_id, (chrom, begin, end) in enumerate(regions):
+            if chrom not in chroms:
+                logger.warning(f"queryRegions :: region {region_id} :: chromosome {chrom} not in index")
+                continue
+
+            begin = 0   if begin is None else begin
+            end   = inf if end   is None else end
+
+            assert begin <= end, f"region {region_id} :: begin {begin} <= end {end}"
+
+            if begin == end:
+                continue
+
+            byChrom.setdefault(chrom, []).append((begin, end, region_id))
+
+        for chrom in sorted(byChrom, key=chroms.index):
+            chromRegions = sorted(byChrom[chrom])
+
+            groups       = []
+            for region in chromRegions:
+                firstReal, lastReal = self._regionBlocks(chrom, region[0] or None, None if region[1] == inf else region[1])
+
+                if groups and (region[0] <= groups[-1][1] or firstReal <= groups[-1][3]):
+                    groups[-1][1] = max(groups[-1][1], region[1])
+                    groups[-1][2].append(region)
+                    groups[-1][3] = max(groups[-1][3], lastReal)
+                else:
+                    groups.append([region[0], region[1], [region], lastReal])
+
+            if getLogLevel() == "DEBUG":
+                logger.debug(f"queryRegions :: chrom {chrom} regions {len(chromRegions)} groups {len(groups)}")
+
+            for groupBegin, groupEnd, groupRegions, _ in groups:
+                groupBegin = None if groupBegin == 0   else groupBegin
+                groupEnd   = None if groupEnd   == inf else groupEnd
+
+                # regions overlapping the current record. regions are sorted
+                # by begin and records come sorted by position
+                pending = 0
+                active  = []
+
+                for record in self.getChromosomeIter(chrom, begin=groupBegin, end=groupEnd, asLine=asLine, asRecord=asRecord):
+                    pos = record.pos if asRecord else int(record.split("\t", 2)[1] if asLine else record[1])
+
+                    while pending < len(groupRegions) and groupRegions[pending][0] <= pos:
+                        active.append(groupRegions[pending])
+                        pending += 1
+
+                    if active and any(region[1] <= pos for region in active):
+                        active = [region for region in active if region[1] > pos]
+
+                    for region in active:
+                        yield region[2], record
+
+    def parallelQuery(self, regions, max_workers=None, ordered=True, asLine=False, columns=None, asRecord=False, window=TabixDefaults.PWINDOW):
+        # runs independent region queries on a thread pool. block inflation
+        # releases the GIL, each stream takes its own handle from the pool
+        # and the block cache is shared. yields (region_id, records) in input
+        # order if ordered, else as the queries complete.
+        if isinstance(regions, str):
+            regions = readBed(regions)
+
+        chroms = self.chromosomes
+
+        def query(chrom, begin, end):
+            if chrom not in chroms:
+                logger.warning(f"parallelQuery :: chromosome {chrom} not in index")
+                return []
+
+            return list(self.getChromosomeIter(chrom, begin=begin, end=end, asLine=asLine, columns=columns, asRecord=asRecord))
+
+        # at most workers * window queries are submitted (and their results
+        # held) at once. closing the generator cancels the ones not started
+        workers  = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        regions  = enumerate(regions)
+        pending  = OrderedDict()
+
+        def submit():
+            for region_id, region in regions:
+                pending[executor.submit(query, *region)] = region_id
+                if len(pending) >= workers * window:
+                    break
+
+        try:
+            submit()
+
+            while pending:
+                if ordered:
+                    future, region_id = pending.popitem(last=False)
+                    result            = future.result()
+                    submit()
+                    yield region_id, result
+
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        region_id = pending.pop(future)
+                        submit()
+                        yield region_id, future.result()
+
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    async def aquery(self, chrom, begin=None, end=None, asLine=False, columns=None, asRecord=False, batchSize=TabixDefaults.ABATCH):
+        # async iterator over getChromosomeIter. reading and inflating runs
+        # on a bounded executor in batches of batchSize rows; the next batch
+        # is only read when the consumer asks for it (back-pressure) and at
+        # most asyncWorkers batches of this Tabix run at once. nothing which
+        # may touch the file (column names, lazy block lookups) runs on the
+        # event loop: the iterator is created with the first batch.
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            if self._aexecutor is None:
+                self._aexecutor = ThreadPoolExecutor(max_workers=self._aworkers)
+
+            if self._alimit is None or self._alimit[0] is not loop:
+                self._alimit = (loop, asyncio.Semaphore(self._aworkers))
+
+            executor = self._aexecutor
+            limit    = self._alimit[1]
+
+        rows     = None
+        rowsLock = threading.Lock() # a cancelled batch may still be running
+
+        def nextBatch():
+            nonlocal rows
+            with rowsLock:
+                if rows is None:
+                    rows = self.getChromosomeIter(chrom, begin=begin, end=end, asLine=asLine, columns=columns, asRecord=asRecord)
+                return list(itertools.islice(rows, batchSize))
+
+        def closeRows():
+            with rowsLock:
+                if rows is not None:
+                    rows.close()
+
+        try:
+            while True:
+                async with limit:
+                    batch = await loop.run_in_executor(executor, nextBatch)
+
+                for row in batch:
+                    yield row
+
+                if len(batch) < batchSize:
+                    break
+
+        finally:
+            try:
+                executor.submit(closeRows)
+            except RuntimeError: # executor already shut down
+                closeRows()
+
+    def getFirstBlock(self, chrom):
+        # block information of the first block of chrom. looked up in the
+        # data file and memoised if the index was read lazily
+        key = (chrom, "first_block")
+        with self._lock:
+            if key not in self._blockData:
+                ref = self._data["refs"][self.chromosomes.index(chrom)]
+                nfo = ref["first_block"]
+
+                if "block_len" not in nfo:
+                    with open(self._inbgz, "rb") as inf:
+                        nfo = getPosDataLazy(inf, nfo, chrom)
+
+                self._blockData[key] = nfo
+
+        return self._blockData[key]
+
+    def getLastBlock(self, chrom):
+        key = (chrom, "last_block")
+        with self._lock:
+            if key not in self._blockData:
+                ref = self._data["refs"][self.chromosomes.index(chrom)]
+                nfo = ref["last_block"]
+
+                if "block_len" not in nfo:
+                    # the end of the last chunk may point past the last block (EOF).
+                    # walk from the last window of the linear index instead
+                    with open(self._inbgz, "rb") as inf:
+                        ioff = self._refs[self.chromosomes.index(chrom)].ioffs[-1]
+                        nfo  = {"bin_n": -1, "chunk_n": -1, "real": ioff >> 16, "bytes": ioff & TABIX_BLOCK_BYTES_MASK}
+                        nfo  = getLastBlock(inf, chrom, getPosDataLazy(inf, nfo, chrom))
+
+                self._blockData[key] = nfo
+
+        return self._blockData[key]
+
+    def getChromosomeIterTBJ(self, chrom, begin=None, end=None, asLine=False, columns=None, asRecord=False):
         numCols = self.numCols
 
         idx     = self.chromosomes.index(chrom)
 
         ref     = self._data["refs"   ][idx]
-        intvs   = ref["intvs"]
 
-        first_block = ref["first_block"]
-        last_block  = ref["last_block" ]
+        assert ref["ref_name"] == chrom
 
-        if "block_len" not in first_block:
-            raise NotImplementedError("block search not implemented")
+        # any end is fine: the bins and the end filter of the stream bound the
+        # rows. the last block of the index may not hold the last row
+        chunks  = getChunks(self._refs[idx], begin=begin, end=end)
 
-        assert ref["ref_name"] == chrom
-        assert end is None or (end <= last_block["last_pos"]), f"(end {end:12,d} <= last_block['last_pos'] {last_block['last_pos']:12,d}) - last_block {last_block}"
-
-        intvsBegin = None
-        if begin is not None:
-            for rpos, r in enumerate(intvs):
-                if r["first_pos"] == begin:
-                    r["chunk"] = rpos
-                    intvsBegin = r
-                    break
-                elif r["first_pos"] > begin:
-                    if rpos == 0: #first block
-                        r["chunk_n"] = rpos
-                        intvsBegin = r
-                        break
-                    else:
-                        r = intvs[rpos - 1] #went too far. go back one block
-                        r["chunk_n"] = rpos - 1
-                        intvsBegin = r
-                        break
-            if intvsBegin is None: #not in any block. use last block
-                r = intvs[-1]
-                r["chunk_n"] = -1
-                intvsBegin = r # last block
-        else:
-            r = intvs[0]
-            r["chunk_n"] = 0
-            intvsBegin = r
-
-        # logger.debug(f"begin      {begin}")
-        # logger.debug(f"end        {end}"  )
-        # logger.debug(f"intvs[ 0]  {intvs[ 0]}")
-        # logger.debug(f"intvs[-2]  {intvs[-2]}")
-        # logger.debug(f"intvs[-1]  {intvs[-1]}")
-        logger.debug(f"intvsBegin {intvsBegin}")
-
-        with openGzipStream(self._inbgz, intvsBegin["real"], 0, asLine=asLine, chrom=chrom, begin=begin, end=end) as fhd:
-            for line in fhd:
+        if getLogLevel() == "DEBUG":
+            logger.debug(f"getChromosomeIterTBJ :: chrom {chrom} begin {begin} end {end} chunks {len(chunks)}")
+            for chk_beg, chk_end in chunks:
+                logger.debug(f"getChromosomeIterTBJ ::   chunk {chk_beg >> 16:12,d} {chk_beg & TABIX_BLOCK_BYTES_MASK:6,d} - {chk_end >> 16:12,d} {chk_end & TABIX_BLOCK_BYTES_MASK:6,d}")
+
+        for chk_beg, chk_end in chunks:
+            for line in self.openStream(chk_beg >> 16, chk_beg & TABIX_BLOCK_BYTES_MASK, asLine=asLine, chrom=chrom, begin=begin, end=end, endVirtual=chk_end, columns=columns, asRecord=asRecord):
                 yield line
 
-    def getChromosomeIterTBK(self, chrom, begin=None, end=None, asLine=False):
+    def getChromosomeIterTBK(self, chrom, begin=None, end=None, asLine=False, columns=None, asRecord=False):
         numCols    = self.numCols
 
         idx        = self.chromosomes.index(chrom)
@@ -273,16 +869,17 @@ class Tabix(TabixDefaults):
             logger.debug( "getChromosomeIterTBK ::   lasts   {} | {}".format(t2l(lasts[:4] ), t2l(lasts[-4:]) ))
             logger.debug( "getChromosomeIterTBK ::   rows    {} | {}".format(t2l(rows[:4]  ), t2l(rows[-4:])  ))
 
-        if begin is not None and begin > lasts[-1]:
-            logger.debug(f"getChromosomeIterTBK :: EMPTY :: begin {begin if begin is not None else -1:12,d} <= lasts[-1] {lasts[-1]:12,d}")
-            return []
-
-        if end   is not None and end   > lasts[-1]:
-            logger.debug(f"getChromosomeIterTBK :: EMPTY :: end   {end   if end   is not None else -1:12,d} <= lasts[-1] {lasts[-1]:12,d}")
-            return []
+        # begin or end after lasts[-1] still have to be streamed: rows may
+        # start in the blocks after the last indexed one (too few rows to be
+        # indexed) or in the first block of the next chromosome
 
         real = 0
-        if begin is not None:
+        if begin is None:
+            if idx > 0:
+                # rows of this chromosome may start in the last block of the previous one
+                real = self._data["realPositions"][idx - 1][-1]
+
+        else:
             pos  = bisect.bisect_left(firsts, begin)
 
             if pos >= len(firsts):
@@ -307,14 +904,38 @@ class Tabix(TabixDefaults):
                 real = -1
 
         if real == -1:
+            # begin is before the first indexed row. read from where the rows
+            # of this chromosome may start, as if begin was None
             if idx == 0:
-                raise ValueError(f"begin {begin} smallest then begining {firsts[0]}")
+                logger.debug("reverting to the begining of the file")
+                real = 0
             else:
                 logger.debug("reverting to previous chromosome")
                 real = self._data["realPositions"][idx - 1][-1]
 
         logger.debug(f"POSITION :: real {real:12,d}")
 
-        with openGzipStream(self._inbgz, real, 0, asLine=asLine, chrom=chrom, begin=begin, end=end) as fhd:
-            for line in fhd:
-                yield line
+        for line in self.openStream(real, None, asLine=asLine, chrom=chrom, begin=begin, end=end, columns=columns, asRecord=asRecord):
+            yield line
+
+    def openStream(self, realPos, bytesPos, asLine=False, chrom=None, begin=None, end=None, endVirtual=None, columns=None, asRecord=False):
+        # rows of the data file from a virtual offset, sharing the block cache,
+        # the file handles and the read ahead settings of this Tabix
+        stream = openGzipStream(self._inbgz, realPos, bytesPos, asLine=asLine, chrom=chrom, begin=begin, end=end, cache=self._cache, endVirtual=endVirtual, pool=self._pool, readAhead=self._readAhead, columns=columns, asRecord=asRecord)
+
+        try:
+            with stream as fhd:
+                for line in fhd:
+                    yield line
+
+        finally:
+            with self._lock:
+                for k, v in stream.waits.items():
+                    self._waits[k] += v
+
+    @property
+    def readAheadStats(self):
+        # how often the parser waited for the read ahead thread (consumer) and
+        # how often the read ahead thread waited on a full queue (producer)
+        with self._lock:
+            return dict(self._waits, depth=self._readAhead)
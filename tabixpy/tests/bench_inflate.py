@@ -0,0 +1,55 @@
+import sys
+import gzip
+import time
+
+sys.path.insert(0, '../..')
+
+import tabixpy
+
+from tabixpy._gzip import scanBlocks, inflateBlock
+
+# per block inflate time of gzip.decompress against the raw deflate decoders
+# usage: python3 bench_inflate.py [file.vcf.gz] [repeats]
+
+def readBlocks(infile, maxBlocks=2000):
+    blocks = []
+    with open(infile, "rb") as fhd:
+        for real_pos, block_len, _ in scanBlocks(infile):
+            fhd.seek(real_pos)
+            blocks.append(fhd.read(block_len))
+            if len(blocks) == maxBlocks:
+                break
+    return blocks
+
+def bench(name, func, blocks, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for block in blocks:
+            func(block)
+    elapsed = time.perf_counter() - start
+    per_block = elapsed / (repeats * len(blocks)) * 1e6
+    print(f"{name:12s} {per_block:10,.2f} us/block {elapsed:8.3f} s")
+    return per_block
+
+def main():
+    infile  = sys.argv[1] if len(sys.argv) > 1 else "annotated_tomato_150.100000.vcf.gz"
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    blocks  = readBlocks(infile)
+    print(f"{infile} :: {len(blocks)} blocks x {repeats}")
+
+    base    = bench("gzip", gzip.decompress, blocks, repeats)
+
+    for name in tabixpy.INFLATERS:
+        tabixpy.setBlockDecoder(name, verifyCRC=False)
+        speed = bench(name, inflateBlock, blocks, repeats)
+        print(f"{'':12s} {base / speed:10.2f}x")
+
+        tabixpy.setBlockDecoder(name, verifyCRC=True)
+        speed = bench(name + "+crc", inflateBlock, blocks, repeats)
+        print(f"{'':12s} {base / speed:10.2f}x")
+
+    tabixpy.setBlockDecoder("zlib", verifyCRC=False)
+
+if __name__ == "__main__":
+    main()
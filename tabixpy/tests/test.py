@@ -1,5 +1,15 @@
 import os
+import re
 import sys
+import gzip
+import random
+import shutil
+import tempfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 DEBUG     = False
 COMPRESS  = True
@@ -9,6 +19,61 @@ sys.path.insert(0, '../..')
 
 import tabixpy
 
+def parseGT(row, sample_n, ploidy):
+    # allele indexes of one sample, as genotypeMatrix: -1 for missing and
+    # for rows whose FORMAT does not start with GT
+    if len(row) <= 9 + sample_n or row[8].split(":")[0] != "GT":
+        return [-1] * ploidy
+
+    alleles = re.split("[/|]", row[9 + sample_n].split(":")[0])[:ploidy]
+    vals    = [-1 if allele in (".", "") else int(allele) for allele in alleles]
+
+    return vals + [-1] * (ploidy - len(vals))
+
+def checkGenotypes(tb, chrom, begin=None, end=None, samples=None, ploidy=2):
+    # genotypeMatrix against the GT fields parsed cell by cell
+    names    = tb.columnNames[9:]
+    indexes  = list(range(len(names))) if samples is None else [names.index(s) if isinstance(s, str) else s for s in samples]
+
+    rows     = list(tb.getChromosomeIter(chrom, begin=begin, end=end))
+    pos, gts = tb.genotypeMatrix(chrom, begin=begin, end=end, samples=samples, ploidy=ploidy)
+
+    assert gts.shape == (len(rows), len(indexes), ploidy), f"{gts.shape}"
+    assert pos.tolist() == [int(row[1]) for row in rows]
+    assert gts.tolist() == [[parseGT(row, sample_n, ploidy) for sample_n in indexes] for row in rows], f"genotypes {chrom} {begin} {end} {samples} {ploidy}"
+
+def runGenotypeTest():
+    # haploid, multi digit, missing and truncated GT fields, other FORMATs
+    # and ploidies through the vectorised decoder and its fallback
+    if np is None:
+        tabixpy.logger.warning("numpy not installed. skipping genotype test")
+        return
+
+    from tabixpy._gzip import bgzfCompress
+
+    rnd     = random.Random(1)
+    gts     = ["0/1", "1|1", "./.", "0|0", "12/3", "1", "0/1/2", ".", "./1", ".|.", "10|10", "0/", "2|1:"]
+    formats = [("GT", ""), ("GT:DP", ":7"), ("DP:GT", "")]
+    lines   = ["##fileformat=VCFv4.2\n", "#" + "\t".join(["CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", "s0", "s1", "s2", "s3", "s4"]) + "\n"]
+
+    for pos in range(1, 3001):
+        fmt, suffix = formats[rnd.randrange(len(formats))]
+        samples     = [rnd.choice(gts) + suffix for _ in range(5)]
+        lines.append("\t".join(["g1", str(pos), ".", "A", "C", ".", "PASS", ".", fmt] + samples) + "\n")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ingz = os.path.join(tmpdir, "gt.vcf.gz")
+
+        with open(ingz, "wb") as fhd:
+            fhd.write(bgzfCompress("".join(lines).encode()))
+
+        tb = tabixpy.Tabix(ingz, indexType=tabixpy.Formats.TBK)
+        tb.load()
+
+        for ploidy in (1, 2, 3):
+            checkGenotypes(tb, "g1", ploidy=ploidy)
+            checkGenotypes(tb, "g1", begin=100, end=2000, samples=["s4", 1], ploidy=ploidy)
+
 def runTest(testName, infile, expects, indexType):
     tb         = tabixpy.Tabix(infile, indexType=indexType)
 
@@ -75,12 +140,149 @@ def runTest(testName, infile, expects, indexType):
 
         assert len(vals) == count, f"{len(vals)} == {count}"
 
+        numRows = tb.count(chrom, begin=begin, end=end)
+        assert numRows == count, f"count {numRows} == {count}"
+
+    # all the regions at once
+    regions = [(tb.chromosomes[chrom_idx], begin, end) for chrom_idx, begin, end, _, _, _ in expects]
+    counts  = [0] * len(regions)
+
+    for region_id, _ in tb.queryRegions(regions):
+        counts[region_id] += 1
+
+    assert counts == [count for *_, count in expects], f"{counts} == {[count for *_, count in expects]}"
+
+    # BED regions start at 0
+    chrom   = tb.chromosomes[expects[0][0]]
+    end     = expects[0][1]
+    with tempfile.NamedTemporaryFile("wt", suffix=".bed", delete=False) as fhd:
+        fhd.write(f"{chrom}\t0\t{end - 1}\n")
+
+    try:
+        bedCount = sum(1 for _ in tb.queryRegions(fhd.name))
+    finally:
+        os.remove(fhd.name)
+
+    count   = sum(1 for _ in tb.getChromosomeIter(chrom, end=end))
+    assert bedCount == count, f"{bedCount} == {count}"
+
+    # selected columns are the same slice of the full rows. columns after
+    # the last one of a row are None
+    chrom, begin, end = tb.chromosomes[expects[0][0]], expects[0][1], expects[0][2]
+    rows              = list(tb.getChromosomeIter(chrom, begin=begin, end=end))
+    numCols           = len(tb.columnNames)
+
+    cols = list(tb.getChromosomeIter(chrom, begin=begin, end=end, columns=["CHROM", "POS", "ALT"]))
+    assert cols == [(row[0], row[1], row[4]) for row in rows], f"columns {chrom} {begin} {end}"
+
+    cols = list(tb.getChromosomeIter(chrom, begin=begin, end=end, columns=[1, numCols]))
+    assert cols == [(row[1], None) for row in rows], f"short rows {chrom} {begin} {end}"
+
+    try:
+        tb.getChromosomeIter(chrom, columns=["POS"], asRecord=True)
+        assert False, "columns with asRecord"
+    except ValueError:
+        pass
+
+    if np is not None and len(tb.columnNames) > 9:
+        chrom, begin, end = tb.chromosomes[expects[0][0]], expects[0][1], expects[0][2]
+        numSamples        = len(tb.columnNames) - 9
+        checkGenotypes(tb, chrom, begin=begin, end=end)
+        checkGenotypes(tb, chrom, begin=begin, end=end, samples=[tb.columnNames[-1], numSamples // 2], ploidy=3)
+
+    if indexType == tabixpy.Formats.TBK:
+        # sampling every row gives every row, in file order
+        for chrom in tb.chromosomes:
+            rows = tb.sample(tb.count(chrom), chrom=chrom, seed=1)
+            assert rows == list(tb.getChromosomeIter(chrom)), f"sample {chrom} {len(rows)}"
+
+        # the parallel scan writes the same index, byte for byte. done on a
+        # copy (with the same mtime) so the index in use is left alone
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ingz    = os.path.join(tmpdir, os.path.basename(gzfile))
+            shutil.copy2(gzfile, ingz)
+
+            indexes = []
+            for workers in (1, 2):
+                tabixpy.Tabix(ingz, indexType=tabixpy.Formats.TBK).createTBK(compress=False, workers=workers)
+
+                with open(ingz + ".tbk", "rb") as fhd:
+                    indexes.append(fhd.read())
+
+            assert indexes[0] == indexes[1], f"{testName} TBK of 1 and 2 workers differ"
+
+def runTBITest(testName, infile, expects):
+    # the .tbi written by createTBI reads back through readTabix to the same
+    # query results. done on a copy so an existing .tbi is left alone
+    gzfile = tabixpy.Tabix(infile).bgz
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ingz = os.path.join(tmpdir, os.path.basename(gzfile))
+        shutil.copy(gzfile, ingz)
+
+        tabixpy.Tabix(ingz, indexType=tabixpy.Formats.TBJ).createTBI()
+
+        runTest(testName, ingz, expects, tabixpy.Formats.TBJ)
+
+def runUpdateTest(testName, infile):
+    # a TBK index updated after rows were appended to the BGZ file is the
+    # same as one created from the whole file
+    from tabixpy._gzip import bgzfCompress
+
+    gzfile = tabixpy.Tabix(infile).bgz
+
+    with gzip.open(gzfile, "rb") as fhd:
+        lines = fhd.read().splitlines(True)
+
+    header = [line for line in lines if line.startswith(b"#")]
+    rows   = lines[len(header):]
+    half   = len(rows) // 2
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ingz   = os.path.join(tmpdir, os.path.basename(gzfile))
+        fullgz = os.path.join(tmpdir, "full.vcf.gz")
+
+        with open(ingz, "wb") as fhd:
+            fhd.write(bgzfCompress(b"".join(header + rows[:half])))
+
+        tb = tabixpy.Tabix(ingz, indexType=tabixpy.Formats.TBK)
+        tb.load()
+
+        assert not tb.updateTBK(), f"{testName} update of an unchanged file"
+
+        with open(ingz, "ab") as fhd:
+            fhd.write(bgzfCompress(b"".join(rows[half:])))
+
+        assert tb.updateTBK(), f"{testName} update of an appended file"
+
+        shutil.copy2(ingz, fullgz)
+
+        full = tabixpy.Tabix(fullgz, indexType=tabixpy.Formats.TBK)
+        full.load()
+
+        updated = tabixpy.Tabix(ingz, indexType=tabixpy.Formats.TBK)
+        updated.load()
+
+        assert updated.data == full.data, f"{testName} updated TBK differs from the created one"
+
 def runTests(tests, indexTypes):
     for indexType in indexTypes:
         for testname, infile, expects in tests:
             if os.path.exists(infile):
                 runTest(testname, infile, expects, indexType)
 
+    for testname, infile, expects in tests:
+        if not os.path.exists(infile):
+            continue
+
+        if tabixpy.Formats.TBJ in indexTypes:
+            runTBITest(testname, infile, expects)
+
+        if tabixpy.Formats.TBK in indexTypes:
+            runUpdateTest(testname, infile)
+
+    runGenotypeTest()
+
 def main():
     # tabixpy.setLogLevel(tabixpy.logging.DEBUG)
     